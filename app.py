@@ -5,132 +5,2838 @@ author_url: https://downchurch.studio/
 version: 1.0
 """
 
-from flask import Flask, request, jsonify, Response, send_from_directory
-import os, subprocess, re, asyncio, time, logging, markdown
-import whisper
+from flask import Flask, Request, request, jsonify, Response, send_file, stream_with_context, g
+import os, sys, subprocess, re, asyncio, time, logging, json, queue, threading, http.client, hashlib, uuid, secrets, sqlite3
+import argparse, csv, random, zlib, functools, atexit, gzip, shutil, io, tempfile, html, heapq, itertools, math, contextlib, contextvars
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit, parse_qs
 from werkzeug.utils import secure_filename
-from bs4 import BeautifulSoup
+from werkzeug.security import safe_join
+
+STARTUP_STARTED = time.monotonic()
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = "uploads"
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+app.config["LLM_MODEL"] = os.environ.get("QUEST_LLM_MODEL", "llama3.2")
+app.config["LLM_BACKEND"] = os.environ.get("QUEST_LLM_BACKEND", "http")
+app.config["OLLAMA_URL"] = os.environ.get("QUEST_OLLAMA_URL", "http://127.0.0.1:11434")
+app.config["OLLAMA_POOL_SIZE"] = int(os.environ.get("QUEST_OLLAMA_POOL_SIZE", "4"))
+app.config["OLLAMA_TIMEOUT"] = float(os.environ.get("QUEST_OLLAMA_TIMEOUT", "40"))
+app.config["OLLAMA_KEEP_ALIVE"] = os.environ.get("QUEST_OLLAMA_KEEP_ALIVE", "30m")
+app.config["LLM_CONCURRENCY"] = int(os.environ.get("QUEST_LLM_CONCURRENCY", "2"))
+app.config["LLM_QUEUE_SIZE"] = int(os.environ.get("QUEST_LLM_QUEUE_SIZE", "32"))
+app.config["LLM_QUEUE_TIMEOUT"] = float(os.environ.get("QUEST_LLM_QUEUE_TIMEOUT", "30"))
+app.config["LLM_CACHE_MAX_ENTRIES"] = int(os.environ.get("QUEST_LLM_CACHE_MAX_ENTRIES", "1024"))
+app.config["LLM_CACHE_TTL"] = float(os.environ.get("QUEST_LLM_CACHE_TTL_HOURS", "24")) * 3600
+app.config["LLM_CACHE_DB"] = os.environ.get("QUEST_LLM_CACHE_DB", "")
+app.config["LLM_CONVERSATION"] = os.environ.get("QUEST_LLM_CONVERSATION", "1") == "1"
+app.config["LLM_HISTORY_TURNS"] = int(os.environ.get("QUEST_LLM_HISTORY_TURNS", "0"))
+app.config["BLOCKING_WORKERS"] = int(os.environ.get("QUEST_BLOCKING_WORKERS", "32"))
+app.config["TTS_CONCURRENCY"] = int(os.environ.get("QUEST_TTS_CONCURRENCY", "4"))
+app.config["TTS_MIN_SENTENCE_CHARS"] = int(os.environ.get("QUEST_TTS_MIN_SENTENCE_CHARS", "40"))
+app.config["TTS_CACHE_MAX_BYTES"] = int(float(os.environ.get("QUEST_TTS_CACHE_MAX_MB", "512")) * 1024 * 1024)
+app.config["ASR_ENGINE"] = os.environ.get("QUEST_ASR_ENGINE", "whisper")
+app.config["ASR_DEVICE"] = os.environ.get("QUEST_ASR_DEVICE") or None
+app.config["ASR_COMPUTE_TYPE"] = os.environ.get("QUEST_ASR_COMPUTE_TYPE", "int8")
+app.config["WHISPER_MODEL"] = os.environ.get("QUEST_WHISPER_MODEL", "base")
+app.config["WHISPER_MODEL_SIZES"] = os.environ.get("QUEST_WHISPER_MODEL_SIZES", "")
+app.config["WHISPER_TORCH_THREADS"] = int(os.environ.get("QUEST_WHISPER_TORCH_THREADS", "2"))
+app.config["WHISPER_WORKERS"] = int(os.environ.get(
+    "QUEST_WHISPER_WORKERS", str(max(1, (os.cpu_count() or 1) // app.config["WHISPER_TORCH_THREADS"]))
+))
+app.config["WHISPER_QUEUE_SIZE"] = int(os.environ.get("QUEST_WHISPER_QUEUE_SIZE", "32"))
+app.config["WHISPER_BATCH_SIZE"] = int(os.environ.get("QUEST_WHISPER_BATCH_SIZE", "4"))
+app.config["WHISPER_BATCH_WINDOW_MS"] = int(os.environ.get("QUEST_WHISPER_BATCH_WINDOW_MS", "50"))
+app.config["WHISPER_TIMEOUT"] = float(os.environ.get("QUEST_WHISPER_TIMEOUT", "120"))
+app.config["WARMUP_LLM"] = os.environ.get("QUEST_WARMUP_LLM", "1") == "1"
+app.config["PREFETCH_POOL_SIZE"] = int(os.environ.get("QUEST_PREFETCH_POOL_SIZE", "2"))
+app.config["PREFETCH_CONCURRENCY"] = int(os.environ.get("QUEST_PREFETCH_CONCURRENCY", "2"))
+app.config["PREFETCH_MAX_TOPICS"] = int(os.environ.get("QUEST_PREFETCH_MAX_TOPICS", "64"))
+app.config["QUESTION_CANDIDATES"] = int(os.environ.get("QUEST_QUESTION_CANDIDATES", "3"))
+app.config["QUESTION_MAX_ATTEMPTS"] = int(os.environ.get("QUEST_QUESTION_MAX_ATTEMPTS", "3"))
+app.config["QUESTION_SIMILARITY"] = float(os.environ.get("QUEST_QUESTION_SIMILARITY", "0.7"))
+app.config["QUESTION_INDEX_CAPACITY"] = int(os.environ.get("QUEST_QUESTION_INDEX_CAPACITY", "100"))
+app.config["INTERACTION_LOG"] = os.environ.get("QUEST_INTERACTION_LOG", "logs/interactions.jsonl")
+app.config["INTERACTION_LOG_MAX_BYTES"] = int(float(os.environ.get("QUEST_INTERACTION_LOG_MAX_MB", "50")) * 1024 * 1024)
+app.config["INTERACTION_LOG_MAX_AGE"] = float(os.environ.get("QUEST_INTERACTION_LOG_MAX_AGE_HOURS", "24")) * 3600
+app.config["INTERACTION_LOG_FSYNC"] = os.environ.get("QUEST_INTERACTION_LOG_FSYNC", "interval")
+app.config["INTERACTION_LOG_BACKUPS"] = int(os.environ.get("QUEST_INTERACTION_LOG_BACKUPS", "20"))
+app.config["AUDIO_TTL"] = float(os.environ.get("QUEST_AUDIO_TTL_HOURS", "24")) * 3600
+app.config["AUDIO_QUOTA_BYTES"] = int(float(os.environ.get("QUEST_AUDIO_QUOTA_MB", "2048")) * 1024 * 1024)
+app.config["AUDIO_GC_INTERVAL"] = float(os.environ.get("QUEST_AUDIO_GC_INTERVAL", "300"))
+app.config["MAX_UPLOAD_BYTES"] = int(float(os.environ.get("QUEST_MAX_UPLOAD_MB", "25")) * 1024 * 1024)
+app.config["MAX_CONTENT_LENGTH"] = app.config["MAX_UPLOAD_BYTES"] + 64 * 1024
+app.config["UPLOAD_SPOOL_BYTES"] = int(float(os.environ.get("QUEST_UPLOAD_SPOOL_MB", "8")) * 1024 * 1024)
+app.config["PERSIST_UPLOADS"] = os.environ.get("QUEST_PERSIST_UPLOADS", "1") == "1"
+app.config["VAD_ENABLED"] = os.environ.get("QUEST_VAD", "1") == "1"
+app.config["VAD_THRESHOLD_DB"] = float(os.environ.get("QUEST_VAD_THRESHOLD_DB", "12"))
+app.config["VAD_MIN_SILENCE_MS"] = int(os.environ.get("QUEST_VAD_MIN_SILENCE_MS", "600"))
+app.config["VAD_PADDING_MS"] = int(os.environ.get("QUEST_VAD_PADDING_MS", "200"))
+app.config["VAD_MAX_SEGMENT_SECONDS"] = float(os.environ.get("QUEST_VAD_MAX_SEGMENT_SECONDS", "25"))
+app.config["LIVE_STEP_MS"] = int(os.environ.get("QUEST_LIVE_STEP_MS", "1000"))
+app.config["LIVE_MAX_SECONDS"] = float(os.environ.get("QUEST_LIVE_MAX_SECONDS", "300"))
+app.config["AUDIO_OPUS"] = os.environ.get("QUEST_AUDIO_OPUS", "1") == "1"
+app.config["AUDIO_OPUS_BITRATE"] = os.environ.get("QUEST_AUDIO_OPUS_BITRATE", "24k")
+app.config["SESSION_BACKEND"] = os.environ.get("QUEST_SESSION_BACKEND", "memory")
+app.config["SESSION_DB"] = os.environ.get("QUEST_SESSION_DB", "sessions.sqlite3")
+app.config["SESSION_TTL"] = int(os.environ.get("QUEST_SESSION_TTL", "7200"))
+app.config["MAX_SESSIONS"] = int(os.environ.get("QUEST_MAX_SESSIONS", "1000"))
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+
+class QuestRequest(Request):
+    # Uploads bis UPLOAD_SPOOL_BYTES bleiben im Speicher statt in einer Temp-Datei
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config["UPLOAD_SPOOL_BYTES"])
+
+app.request_class = QuestRequest
+
+metrics_registry = []
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    @staticmethod
+    def _format(pairs):
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, list(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, pairs, value in self.samples():
+            lines.append(f"{name}{self._format(pairs)} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            values = self.function()
+        except Exception:
+            return []
+        return [(self.name, list(zip(self.labels, self._key(labels))), value) for labels, value in values]
+
+class Histogram(Metric):
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+    def __init__(self, name, documentation, labels=(), buckets=None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                pairs = list(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    result.append((f"{self.name}_bucket", pairs + [("le", f"{bound:g}")], cumulative))
+                result.append((f"{self.name}_bucket", pairs + [("le", "+Inf")], count))
+                result.append((f"{self.name}_sum", pairs, total))
+                result.append((f"{self.name}_count", pairs, count))
+        return result
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+HTTP_REQUESTS = Counter("quest_http_requests_total", "HTTP-Anfragen nach Route, Methode und Status", ("route", "method", "status"))
+HTTP_DURATION = Histogram("quest_http_request_duration_seconds", "Antwortzeit bis zum Start der Antwort", ("route",))
+HTTP_IN_FLIGHT = Gauge("quest_http_requests_in_flight", "Aktuell bearbeitete HTTP-Anfragen")
+STAGE_SECONDS = Histogram("quest_stage_duration_seconds", "Dauer einzelner Verarbeitungsschritte", ("stage",))
+STAGE_ERRORS = Counter("quest_stage_errors_total", "Fehlgeschlagene Verarbeitungsschritte", ("stage",))
+STAGE_TIMEOUTS = Counter("quest_stage_timeouts_total", "Verarbeitungsschritte mit Zeitüberschreitung", ("stage",))
+LLM_QUEUE_WAIT = Histogram("quest_llm_queue_wait_seconds", "Wartezeit auf einen Platz beim Sprachmodell", ("priority",))
+LLM_REJECTIONS = Counter("quest_llm_rejections_total", "Abgewiesene Anfragen an das Sprachmodell", ("status",))
+LLM_TOKENS = Counter("quest_llm_tokens_total", "Vom Sprachmodell verarbeitete Tokens (prompt_eval: neu vorberechnet, eval: erzeugt)", ("kind",))
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except (LLMTimeoutError, TimeoutError, FutureTimeoutError, subprocess.TimeoutExpired):
+        STAGE_TIMEOUTS.inc(stage=stage)
+        raise
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+SESSION_COOKIE = "quest_session"
+
+def _minhash_permutations(count, prime, seed=1055):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, prime), rng.randrange(0, prime)) for _ in range(count)]
+
+class QuestionIndex:
+    num_perm = 32
+    prime = (1 << 31) - 1
+    _permutations = _minhash_permutations(num_perm, prime)
+
+    def __init__(self, capacity=100, threshold=0.7, entries=()):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._entries = deque(entries, maxlen=capacity)
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+    @classmethod
+    def signature(cls, normalized):
+        padded = f" {normalized} "
+        shingles = {padded[i:i + 4] for i in range(max(1, len(padded) - 3))}
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+        return [min((a * h + b) % cls.prime for h in hashes) for a, b in cls._permutations]
+
+    def similarity(self, question):
+        normalized = self.normalize(question)
+        signature = self.signature(normalized)
+        best = 0.0
+        for other, other_signature in self._entries:
+            if other == normalized:
+                return 1.0
+            matches = sum(x == y for x, y in zip(signature, other_signature))
+            best = max(best, matches / self.num_perm)
+        return best
+
+    def __contains__(self, question):
+        return self.similarity(question) >= self.threshold
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, question):
+        normalized = self.normalize(question)
+        self._entries.append((normalized, self.signature(normalized)))
+
+    def to_list(self):
+        return [[normalized, signature] for normalized, signature in self._entries]
+
+    @classmethod
+    def from_list(cls, items, capacity=100, threshold=0.7):
+        entries = []
+        for item in items:
+            if isinstance(item, str):
+                normalized = cls.normalize(item)
+                entries.append((normalized, cls.signature(normalized)))
+            else:
+                entries.append((item[0], item[1]))
+        return cls(capacity, threshold, entries)
+
+class SessionState:
+    def __init__(self, question_count=0, current_question="", asked_questions=None, conversation=None, conversation_language=""):
+        self.session_id = None
+        self.question_count = question_count
+        self.current_question = current_question
+        self.asked_questions = QuestionIndex.from_list(
+            asked_questions or (), app.config["QUESTION_INDEX_CAPACITY"], app.config["QUESTION_SIMILARITY"]
+        )
+        self.conversation = list(conversation or ())
+        self.conversation_language = conversation_language
+
+    @property
+    def public_id(self):
+        return public_session_id(self.session_id)
+
+    def to_dict(self):
+        return {
+            "question_count": self.question_count,
+            "current_question": self.current_question,
+            "asked_questions": self.asked_questions.to_list(),
+            "conversation": self.conversation,
+            "conversation_language": self.conversation_language
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+class InMemorySessionStore:
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            expires_at, state = entry
+            if expires_at < time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return state
+
+    def save(self, sid, state):
+        now = time.time()
+        with self._lock:
+            self._sessions[sid] = (now + self.ttl, state)
+            self._sessions.move_to_end(sid)
+            while self._sessions:
+                oldest_sid, (expires_at, _) = next(iter(self._sessions.items()))
+                if len(self._sessions) <= self.max_sessions and expires_at >= now:
+                    break
+                del self._sessions[oldest_sid]
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SQLiteSessionStore:
+    def __init__(self, path, ttl, max_sessions, purge_interval=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.purge_interval = purge_interval
+        self._writes = 0
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE sid = ? AND expires_at >= ?", (sid, time.time())
+        ).fetchone()
+        return SessionState.from_dict(json.loads(row[0])) if row else None
+
+    def save(self, sid, state):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+            (sid, json.dumps(state.to_dict(), ensure_ascii=False), now + self.ttl, now)
+        )
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            self.purge(now)
+
+    def purge(self, now=None):
+        conn = self._connection()
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now or time.time(),))
+        conn.execute(
+            "DELETE FROM sessions WHERE sid IN "
+            "(SELECT sid FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,)
+        )
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def create_session_store():
+    if app.config["SESSION_BACKEND"] == "sqlite":
+        return SQLiteSessionStore(app.config["SESSION_DB"], app.config["SESSION_TTL"], app.config["MAX_SESSIONS"])
+    return InMemorySessionStore(app.config["SESSION_TTL"], app.config["MAX_SESSIONS"])
+
+session_store = create_session_store()
+
+def load_session(sid):
+    state = session_store.load(sid) if sid else None
+    if state is None:
+        sid = secrets.token_urlsafe(24)
+        state = SessionState()
+    state.session_id = sid
+    return sid, state
+
+def public_session_id(sid):
+    # Das Cookie ist das einzige Geheimnis der Sitzung, in URLs, Ordnernamen und Logs steht nur ein daraus abgeleiteter Wert
+    return hashlib.sha256(sid.encode("utf-8")).hexdigest()[:32] if sid else None
+
+def current_session():
+    if "session_state" not in g:
+        g.session_id, g.session_state = load_session(request.cookies.get(SESSION_COOKIE))
+    return g.session_state
+
+@app.after_request
+def save_session(response):
+    if "session_state" in g:
+        session_store.save(g.session_id, g.session_state)
+        response.set_cookie(
+            SESSION_COOKIE, g.session_id, max_age=app.config["SESSION_TTL"], httponly=True, samesite="Lax"
+        )
+    return response
+
+class AsyncRuntime:
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(self._with_request_id(coro, request_id_var.get()), self.loop)
+
+    @staticmethod
+    async def _with_request_id(coro, request_id):
+        request_id_var.set(request_id)
+        return await coro
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+async_runtime = AsyncRuntime()
+blocking_executor = ThreadPoolExecutor(max_workers=app.config["BLOCKING_WORKERS"], thread_name_prefix="blocking")
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, functools.partial(context.run, func, *args, **kwargs))
+
+class LLMRequestError(Exception):
+    pass
+
+class LLMTimeoutError(LLMRequestError):
+    pass
+
+class LLMOverloaded(LLMRequestError):
+    def __init__(self, message, status=503, retry_after=5):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+LLM_PRIORITY_INTERACTIVE = 0
+LLM_PRIORITY_QUESTION = 1
+LLM_PRIORITY_PREFETCH = 2
+LLM_PRIORITY_NAMES = {
+    LLM_PRIORITY_INTERACTIVE: "interactive",
+    LLM_PRIORITY_QUESTION: "question",
+    LLM_PRIORITY_PREFETCH: "prefetch"
+}
+
+class LLMScheduler:
+    def __init__(self, concurrency, queue_size, max_wait):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.evicted = 0
+        self.avg_service = None
+        self._active = 0
+        self._waiting = []
+        self._order = itertools.count()
+        self._wait_times = deque(maxlen=256)
+        self._cond = threading.Condition()
+
+    def _estimate(self, priority):
+        # Grobe Wartezeit: Wartende gleicher oder höherer Priorität, abgearbeitet in Runden à concurrency
+        if self.avg_service is None:
+            return 0.0
+        ahead = sum(1 for entry in self._waiting if entry[0] <= priority)
+        return (ahead // self.concurrency + 1) * self.avg_service
+
+    def acquire(self, priority):
+        started = time.monotonic()
+        with self._cond:
+            if self._active < self.concurrency and not self._waiting:
+                self._active += 1
+                self.admitted += 1
+                self._wait_times.append(0.0)
+                LLM_QUEUE_WAIT.observe(0.0, priority=LLM_PRIORITY_NAMES.get(priority, priority))
+                return
+            estimate = self._estimate(priority)
+            if estimate > self.max_wait:
+                self.rejected += 1
+                raise LLMOverloaded(
+                    "Das Sprachmodell ist ausgelastet. Bitte später erneut versuchen.",
+                    status=503, retry_after=math.ceil(estimate)
+                )
+            if len(self._waiting) >= self.queue_size:
+                # Bei QUEST_LLM_QUEUE_SIZE=0 gibt es nichts zu verdrängen
+                lowest = max(self._waiting) if self._waiting else None
+                if lowest is None or lowest[0] <= priority:
+                    self.rejected += 1
+                    raise LLMOverloaded(
+                        "Zu viele Anfragen an das Sprachmodell. Bitte später erneut versuchen.",
+                        status=429, retry_after=math.ceil(estimate) or 5
+                    )
+                # Hintergrundarbeit mit niedrigerer Priorität weicht interaktiven Anfragen
+                self._waiting.remove(lowest)
+                heapq.heapify(self._waiting)
+                lowest[2]["error"] = LLMOverloaded("Verdrängt durch eine dringendere Anfrage.", status=503)
+                self.evicted += 1
+                self._cond.notify_all()
+            entry = [priority, next(self._order), {"granted": False, "error": None}]
+            heapq.heappush(self._waiting, entry)
+            deadline = started + self.max_wait
+            while not entry[2]["granted"]:
+                if entry[2]["error"] is not None:
+                    raise entry[2]["error"]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self.expired += 1
+                    raise LLMOverloaded(
+                        "Zeitüberschreitung in der Warteschlange des Sprachmodells.",
+                        status=503, retry_after=math.ceil(self._estimate(priority)) or 5
+                    )
+                self._cond.wait(remaining)
+            self.admitted += 1
+            self._wait_times.append(time.monotonic() - started)
+        LLM_QUEUE_WAIT.observe(time.monotonic() - started, priority=LLM_PRIORITY_NAMES.get(priority, priority))
+
+    def release(self, service_seconds=None):
+        with self._cond:
+            self._active -= 1
+            if service_seconds is not None:
+                self.avg_service = service_seconds if self.avg_service is None else 0.8 * self.avg_service + 0.2 * service_seconds
+            while self._active < self.concurrency and self._waiting:
+                heapq.heappop(self._waiting)[2]["granted"] = True
+                self._active += 1
+            self._cond.notify_all()
+
+    def _admit(self, priority):
+        try:
+            self.acquire(priority)
+        except LLMOverloaded as e:
+            LLM_REJECTIONS.inc(status=e.status)
+            raise
+
+    def run(self, priority, func, *args, **kwargs):
+        self._admit(priority)
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(time.monotonic() - started)
+
+    def reserve(self, priority):
+        # Platz vorab belegen, damit eine Ablehnung noch als HTTP-Fehler und nicht mitten im Stream ankommt
+        self._admit(priority)
+        return LLMSlot(self)
+
+    def stream(self, priority, chunks, slot=None):
+        if not (slot and slot.take()):
+            self._admit(priority)
+        started = time.monotonic()
+        try:
+            yield from chunks
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        with self._cond:
+            waits = list(self._wait_times)
+            return {
+                "concurrency": self.concurrency,
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "waiting_by_priority": {
+                    name: sum(1 for entry in self._waiting if entry[0] == priority)
+                    for priority, name in LLM_PRIORITY_NAMES.items()
+                },
+                "queue_capacity": self.queue_size,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "avg_wait_ms": 1000 * sum(waits) / len(waits) if waits else 0.0,
+                "max_wait_ms": 1000 * max(waits) if waits else 0.0,
+                "avg_service_seconds": round(self.avg_service, 2) if self.avg_service is not None else None
+            }
+
+class LLMSlot:
+    # Wird von genau einem Stream übernommen oder ungenutzt wieder freigegeben
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.held = True
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            held, self.held = self.held, False
+            return held
+
+    def release(self):
+        if self.take():
+            self.scheduler.release()
+
+llm_scheduler = LLMScheduler(
+    app.config["LLM_CONCURRENCY"], app.config["LLM_QUEUE_SIZE"], app.config["LLM_QUEUE_TIMEOUT"]
+)
+
+class OllamaClient:
+    def __init__(self, base_url, model, pool_size=4, timeout=40, keep_alive="30m"):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or (443 if self.scheme == "https" else 80)
+        self.model = model
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.pool_size = pool_size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _new_connection(self, timeout):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _acquire(self, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            raise LLMTimeoutError("Keine freie Verbindung zu Ollama verfügbar.")
+        try:
+            conn = self._idle.get_nowait()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        except queue.Empty:
+            return self._new_connection(timeout), False
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def _open(self, path, payload, timeout):
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        conn, reused = self._acquire(timeout)
+        try:
+            conn.request("POST", path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if not reused:
+                self._slots.release()
+                raise
+            # Die Verbindung aus dem Pool wurde serverseitig geschlossen: einmal neu aufbauen.
+            conn = self._new_connection(timeout)
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                response = conn.getresponse()
+            except BaseException:
+                self._release(conn, False)
+                raise
+        except BaseException:
+            self._release(conn, False)
+            raise
+        if response.status != 200:
+            detail = response.read().decode("utf-8", errors="replace")
+            self._release(conn, not response.will_close)
+            raise LLMRequestError(f"Ollama antwortete mit HTTP {response.status}: {detail.strip()}")
+        return conn, response
+
+    def _request(self, path, payload, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            conn, response = self._open(path, payload, timeout)
+        except TimeoutError as e:
+            raise LLMTimeoutError("Zeitüberschreitung bei der Modellanfrage.") from e
+        try:
+            data = json.loads(response.read().decode("utf-8"))
+        except TimeoutError as e:
+            self._release(conn, False)
+            raise LLMTimeoutError("Zeitüberschreitung bei der Modellanfrage.") from e
+        except BaseException:
+            self._release(conn, False)
+            raise
+        self._release(conn, not response.will_close)
+        if "error" in data:
+            raise LLMRequestError(data["error"])
+        return data
+
+    def _payload(self, options, stream, **fields):
+        payload = {"model": self.model, "stream": stream, "keep_alive": self.keep_alive}
+        if options:
+            payload["options"] = options
+        payload.update(fields)
+        return payload
+
+    def _stream(self, path, payload, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            conn, response = self._open(path, payload, timeout)
+        except TimeoutError as e:
+            raise LLMTimeoutError("Zeitüberschreitung bei der Modellanfrage.") from e
+        finished = False
+        try:
+            for line in response:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line.decode("utf-8"))
+                if "error" in chunk:
+                    raise LLMRequestError(chunk["error"])
+                yield chunk
+                if chunk.get("done"):
+                    finished = True
+                    break
+        except TimeoutError as e:
+            raise LLMTimeoutError("Zeitüberschreitung bei der Modellanfrage.") from e
+        finally:
+            if finished:
+                response.read()
+            self._release(conn, finished and not response.will_close)
+
+    def generate(self, prompt, options=None, timeout=None, **fields):
+        return self._request("/api/generate", self._payload(options, False, prompt=prompt, **fields), timeout)
+
+    def chat(self, messages, options=None, timeout=None, **fields):
+        return self._request("/api/chat", self._payload(options, False, messages=messages, **fields), timeout)
+
+    def generate_stream(self, prompt, options=None, timeout=None, **fields):
+        return self._stream("/api/generate", self._payload(options, True, prompt=prompt, **fields), timeout)
+
+    def chat_stream(self, messages, options=None, timeout=None, **fields):
+        return self._stream("/api/chat", self._payload(options, True, messages=messages, **fields), timeout)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+ollama_client = OllamaClient(
+    app.config["OLLAMA_URL"],
+    app.config["LLM_MODEL"],
+    pool_size=app.config["OLLAMA_POOL_SIZE"],
+    timeout=app.config["OLLAMA_TIMEOUT"],
+    keep_alive=app.config["OLLAMA_KEEP_ALIVE"],
+)
+
+def _query_llm_via_subprocess(input_text):
+    try:
+        process = subprocess.run(
+            ["ollama", "run", app.config["LLM_MODEL"]],
+            input=input_text,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            timeout=app.config["OLLAMA_TIMEOUT"]
+        )
+    except subprocess.TimeoutExpired as e:
+        raise LLMTimeoutError("Zeitüberschreitung bei der Modellanfrage.") from e
+    if process.returncode != 0:
+        raise LLMRequestError(process.stderr.strip())
+    with stage_timer("ansi_cleanup"):
+        return re.sub(r'\x1b\[.*?m', '', process.stdout)
+
+class SingleFlight:
+    # Gleichzeitige identische Aufträge teilen sich eine Berechnung, alle Wartenden erhalten Ergebnis oder Fehler
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def settle(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # Abbruch des Auslösers (GeneratorExit, CancelledError) nicht als Abbruch an die Wartenden weiterreichen
+            future.set_exception(RuntimeError("Die gemeinsame Berechnung wurde abgebrochen."))
+
+    def do(self, key, func, *args, timeout=None, **kwargs):
+        future, leader = self.join(key)
+        if not leader:
+            return future.result(timeout=timeout)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self.settle(key, future, error=e)
+            raise
+        self.settle(key, future, result)
+        return result
+
+    async def do_async(self, key, func, *args, timeout=None, **kwargs):
+        future, leader = self.join(key)
+        if not leader:
+            # shield: ein abbrechender Wartender darf die gemeinsame Berechnung nicht mit abbrechen
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self.settle(key, future, error=e)
+            raise
+        self.settle(key, future, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
+
+llm_flight = SingleFlight()
+tts_flight = SingleFlight()
+
+class LLMCache:
+    def __init__(self, max_entries, ttl, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path or None
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.saved_seconds = 0.0
+        self._writes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.path and self.max_entries > 0:
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, seconds REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def key(self, prompt, model, options=None):
+        normalized = re.sub(r"\s+", " ", prompt).strip()
+        raw = json.dumps([model, options or {}, normalized], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key, use_cache=True):
+        if self.max_entries <= 0:
+            return None
+        if not use_cache:
+            with self._lock:
+                self.bypassed += 1
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[2]
+                return entry[1]
+        if self.path:
+            row = self._connection().execute(
+                "SELECT expires_at, response, seconds FROM llm_cache WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone()
+            if row:
+                with self._lock:
+                    self._remember(key, tuple(row))
+                    self.hits += 1
+                    self.saved_seconds += row[2]
+                return row[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def contains(self, key):
+        # Nachsehen ohne Treffer zu zählen, get zählt beim eigentlichen Abruf
+        if self.max_entries <= 0:
+            return False
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now:
+                return True
+        if self.path:
+            return self._connection().execute(
+                "SELECT 1 FROM llm_cache WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone() is not None
+        return False
+
+    def put(self, key, response, seconds):
+        if self.max_entries <= 0 or not response.strip():
+            return
+        entry = (time.time() + self.ttl, response, seconds)
+        with self._lock:
+            self._remember(key, entry)
+        if self.path:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, seconds, expires_at) VALUES (?, ?, ?, ?)",
+                (key, response, seconds, entry[0])
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._connection().execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "saved_llm_seconds": round(self.saved_seconds, 1)
+            }
+
+llm_cache = LLMCache(app.config["LLM_CACHE_MAX_ENTRIES"], app.config["LLM_CACHE_TTL"], app.config["LLM_CACHE_DB"])
+
+def record_llm_usage(data, usage=None):
+    # Bei wiederverwendetem Kontext zählt prompt_eval_count nur die Prompt-Tokens, die Ollama neu vorberechnen musste
+    counts = {
+        "prompt_eval_count": data.get("prompt_eval_count", 0),
+        "eval_count": data.get("eval_count", 0),
+        "prompt_eval_ms": round(data.get("prompt_eval_duration", 0) / 1e6, 1),
+        "eval_ms": round(data.get("eval_duration", 0) / 1e6, 1)
+    }
+    LLM_TOKENS.inc(counts["prompt_eval_count"], kind="prompt_eval")
+    LLM_TOKENS.inc(counts["eval_count"], kind="eval")
+    if usage is not None:
+        usage.update(counts)
+
+# Mit messages läuft die Anfrage über /api/chat, input_text bleibt der zustandslose Prompt für 'ollama run'
+def _generate_llm(input_text, priority=LLM_PRIORITY_INTERACTIVE, messages=None, usage=None):
+    return llm_scheduler.run(priority, _generate_llm_now, input_text, messages, usage)
+
+def _generate_llm_now(input_text, messages=None, usage=None):
+    with stage_timer("llm"):
+        if app.config["LLM_BACKEND"] == "http":
+            try:
+                if messages:
+                    data = ollama_client.chat(messages)
+                    response = data["message"]["content"]
+                else:
+                    data = ollama_client.generate(input_text)
+                    response = data["response"]
+            except ConnectionError as e:
+                app.logger.warning(f"Ollama-HTTP-API nicht erreichbar, verwende 'ollama run': {e}")
+            else:
+                record_llm_usage(data, usage)
+                return response
+        return _query_llm_via_subprocess(input_text)
+
+def _stream_llm(input_text, priority=LLM_PRIORITY_INTERACTIVE, messages=None, usage=None, slot=None):
+    return llm_scheduler.stream(priority, _stream_llm_now(input_text, messages, usage), slot)
+
+def _stream_llm_now(input_text, messages=None, usage=None):
+    with stage_timer("llm"):
+        if app.config["LLM_BACKEND"] == "http":
+            try:
+                chunks = ollama_client.chat_stream(messages) if messages else ollama_client.generate_stream(input_text)
+                first = next(chunks, None)
+            except ConnectionError as e:
+                app.logger.warning(f"Ollama-HTTP-API nicht erreichbar, verwende 'ollama run': {e}")
+            else:
+                if first is not None:
+                    for chunk in itertools.chain((first,), chunks):
+                        text = chunk.get("message", {}).get("content") if messages else chunk.get("response")
+                        if text:
+                            yield text
+                        if chunk.get("done"):
+                            record_llm_usage(chunk, usage)
+                return
+        yield _query_llm_via_subprocess(input_text)
+
+# Nur für Feedback: Fragen sollen sich gerade nicht wiederholen und laufen daher am Cache vorbei
+def generate_llm_shared(input_text, priority=LLM_PRIORITY_QUESTION):
+    return llm_flight.do(llm_cache.key(input_text, app.config["LLM_MODEL"]), _generate_llm, input_text, priority)
+
+def generate_llm_cached(input_text, use_cache=True, messages=None, usage=None):
+    key = llm_cache.key(input_text, app.config["LLM_MODEL"])
+    cached = llm_cache.get(key, use_cache)
+    if cached is not None:
+        return cached
+
+    def generate():
+        started = time.monotonic()
+        response = _generate_llm(input_text, messages=messages, usage=usage)
+        llm_cache.put(key, response, time.monotonic() - started)
+        return response
+
+    return llm_flight.do(key, generate)
+
+def stream_llm_via_ollama(input_text, use_cache=True, messages=None, usage=None, slot=None):
+    key = llm_cache.key(input_text, app.config["LLM_MODEL"])
+    cached = llm_cache.get(key, use_cache)
+    if cached is not None:
+        if slot:
+            slot.release()
+        yield cached
+        return
+    # Läuft derselbe Prompt bereits, kommt die Antwort am Stück statt als Token-Strom
+    future, leader = llm_flight.join(key)
+    if not leader:
+        if slot:
+            slot.release()
+        yield future.result()
+        return
+    started = time.monotonic()
+    parts = []
+    try:
+        for token in _stream_llm(input_text, messages=messages, usage=usage, slot=slot):
+            parts.append(token)
+            yield token
+    except BaseException as e:
+        llm_flight.settle(key, future, error=e)
+        raise
+    response = "".join(parts)
+    llm_cache.put(key, response, time.monotonic() - started)
+    llm_flight.settle(key, future, response)
+
+class MarkdownStripper:
+    # Entfernt Markdown in einem Durchgang und lässt sich mit Teilstücken des LLM-Stroms füttern.
+    # Block-Präfixe werden pro Zeile erkannt, Inline-Markup bis zum letzten Leerzeichen sofort ausgegeben.
+    block_prefix = re.compile(r'^\s*(?:#{1,6}\s+|>\s?|[-*+]\s+|\d{1,3}\.\s+)+')
+    rule = re.compile(r'^\s*(?:[-*_]\s*){3,}$|^\s*\|?(?:\s*:?-{3,}:?\s*\|)+\s*:?-*:?\s*$')
+    fence = re.compile(r'^\s*(?:```|~~~)')
+    escaped = re.compile(r'\\([\\`*_{}\[\]()#+\-.!|>])')
+    image = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+    link = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+    tag = re.compile(r'</?[A-Za-z][^>]*>')
+    autolink = re.compile(r'<((?:https?|mailto):[^>]+)>')
+    emphasis = re.compile(r'(?<!\w)_{1,2}(?=\S)|(?<=\S)_{1,2}(?!\w)|(?<=\S)\*+|\*+(?=\S)')
+    pause = re.compile(r'.*[.!?:;]\s', re.S)
+    unfinished = re.compile(r'!?\[[^\]]*(?:\]\([^)]*)?$|<[^>]*$|&[#\w]*$')
+
+    def __init__(self):
+        self.line = ""
+        self.started = False
+        self.in_code = False
+
+    def inline(self, text):
+        text = self.escaped.sub(lambda match: f"\x00{ord(match.group(1))}\x00", text)
+        text = self.image.sub(r'\1', text)
+        text = self.link.sub(r'\1', text)
+        text = self.autolink.sub(r'\1', text)
+        text = self.tag.sub('', text)
+        text = self.emphasis.sub('', text.replace('`', '').replace('|', ' '))
+        text = re.sub(r'\x00(\d+)\x00', lambda match: chr(int(match.group(1))), text)
+        return html.unescape(text)
+
+    def _start_line(self, complete):
+        stripped = self.line.strip()
+        # Präfix erst festlegen, wenn genug Zeichen da sind, um Linie, Zaun oder Aufzählung zu erkennen
+        if not complete and (len(stripped) < 8 or re.fullmatch(r'[-*_\s|:#>+\d.)`~]*', stripped)):
+            return False
+        if self.fence.match(self.line):
+            return False
+        self.started = True
+        self.line = self.block_prefix.sub('', self.line).lstrip()
+        return True
+
+    def feed(self, chunk):
+        output = []
+        for part in re.split(r'(\n)', chunk):
+            if part == "\n":
+                output.append(self._complete_line())
+            elif part:
+                self.line += part
+                if not self.in_code:
+                    output.append(self._partial_line())
+        return "".join(output)
+
+    def _complete_line(self):
+        line = self.line
+        self.line = ""
+        started, self.started = self.started, False
+        if not started and self.fence.match(line):
+            self.in_code = not self.in_code
+            return ""
+        if self.in_code:
+            return line + "\n"
+        if not started:
+            if self.rule.match(line):
+                return "\n"
+            line = self.block_prefix.sub('', line).lstrip()
+        return self.inline(line) + "\n"
+
+    def _partial_line(self):
+        if not self.started and not self._start_line(complete=False):
+            return ""
+        # Nur bis zur letzten Satz- oder Teilsatzgrenze ausgeben, der SentenceSplitter wartet ohnehin darauf
+        boundary = self.pause.match(self.line)
+        if not boundary:
+            return ""
+        cut = boundary.end()
+        pending = self.unfinished.search(self.line[:cut])
+        if pending:
+            cut = pending.start()
+        ready, self.line = self.line[:cut], self.line[cut:]
+        return self.inline(ready)
+
+    def flush(self):
+        return self._complete_line() if self.line else ""
+
+def markdown_to_text(md):
+    with stage_timer("markdown"):
+        stripper = MarkdownStripper()
+        text = stripper.feed(md) + stripper.flush()
+        return re.sub(r'\n{3,}', '\n\n', "\n".join(line.strip() for line in text.split("\n"))).strip()
+
+MARKDOWN_SAMPLES = [
+    """**Genauigkeit:** Deine Antwort ist *grammatikalisch* weitgehend korrekt, aber achte auf die Endung in `den Kindern`.
+
+**Flüssigkeit:** Der Text liest sich flüssig, die Sätze sind gut verbunden.
+
+**Interaktion:** Du gehst direkt auf die Frage ein.
+
+**Kohärenz:** Die Gedanken bauen logisch aufeinander auf.
+
+**Umfang:** Der Wortschatz ist angemessen, könnte aber __vielfältiger__ sein.
+
+**Gesamtniveau nach GER:** B1
+
+**Verbesserungsvorschläge:**
+- Verwende Konnektoren wie „außerdem“ & „deshalb“.
+- Übe den Dativ Plural, z.B. mit [Übungen](https://example.org/dativ).
+
+1. Schreibe längere Sätze.
+2. Nutze mehr *Nebensätze* mit **weil**.
+""",
+    """### Feedback
+
+**Accuracy:** Your answer is mostly correct; watch the tense in *"I have went"* → `I have gone`.
+
+**Fluency:** Good pace and natural phrasing.
+
+**Interaction:** You answered the question directly.
+
+**Coherence:** Ideas are well ordered.
+
+**Range:** Vocabulary is adequate &amp; appropriate for the topic.
+
+**Overall CEFR level:** B2
+
+---
+
+**Suggestions for improvement:**
+* Use more linking words such as *however* and *therefore*.
+* Avoid repeating "very" – try _extremely_ or _quite_.
+> Tip: read your answer aloud once more.
+""",
+    """**Précision :** Ta réponse est globalement correcte, mais attention à l'accord dans *les enfants sont partis*.
+
+**Aisance :** Le discours est fluide.
+
+**Interaction :** Tu réponds bien à la question posée.
+
+**Cohérence :** Les idées s'enchaînent logiquement.
+
+**Étendue :** Le vocabulaire est varié.
+
+**Niveau global selon le CECR :** B1
+
+**Suggestions d'amélioration :**
+
+1. Utilise des connecteurs comme « cependant » et « donc ».
+2. Révise le subjonctif après `il faut que`.
+"""
+]
+
+def run_markdown_benchmark(iterations, chunk_size):
+    import markdown
+    from bs4 import BeautifulSoup
+
+    def reference_to_text(md):
+        return BeautifulSoup(markdown.markdown(md), "html.parser").get_text(separator='\n').strip()
+
+    def streamed_to_text(md):
+        stripper = MarkdownStripper()
+        parts = [stripper.feed(md[start:start + chunk_size]) for start in range(0, len(md), chunk_size)]
+        parts.append(stripper.flush())
+        return "".join(parts)
+
+    mismatches = 0
+    for index, sample in enumerate(MARKDOWN_SAMPLES):
+        stripper = MarkdownStripper()
+        if streamed_to_text(sample) != stripper.feed(sample) + stripper.flush():
+            mismatches += 1
+            print(f"Beispiel {index}: Ausgabe bei Teilstücken von {chunk_size} Zeichen weicht ab")
+        current, reference = re.findall(r'\w+', markdown_to_text(sample)), re.findall(r'\w+', reference_to_text(sample))
+        if current != reference:
+            mismatches += 1
+            print(f"Beispiel {index}: Wortfolge weicht von markdown+BeautifulSoup ab")
+            print(f"  neu:      {' '.join(current)}")
+            print(f"  Referenz: {' '.join(reference)}")
+
+    results = {}
+    for name, convert in (("markdown+bs4", reference_to_text), ("MarkdownStripper", markdown_to_text), ("Strom", streamed_to_text)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for sample in MARKDOWN_SAMPLES:
+                convert(sample)
+        results[name] = (time.perf_counter() - started) / (iterations * len(MARKDOWN_SAMPLES)) * 1e6
+
+    print(f"{'Verfahren':<20}{'µs pro Feedback':>18}{'Faktor':>10}")
+    for name, micros in results.items():
+        print(f"{name:<20}{micros:>18.1f}{results['markdown+bs4'] / micros:>10.1f}")
+    if mismatches:
+        raise SystemExit(f"{mismatches} Abweichung(en) gefunden.")
+    return results
+
+class InteractionLog:
+    def __init__(self, path, max_bytes, max_age, fsync="interval", backups=20, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=10000)
+        self._file = None
+        self._file_path = None
+        self._slot_lock = None
+        self._opened_at = 0.0
+        self._last_fsync = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, event, **fields):
+        if self._thread is None:
+            self._start()
+        record = {"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "event": event}
+        if request_id_var.get() != "-":
+            record["request_id"] = request_id_var.get()
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    self._write_batch(records)
+            except Exception as e:
+                app.logger.error(f"Interaktionsprotokoll konnte nicht geschrieben werden: {e}")
+            if closing:
+                if self._file:
+                    self._file.close()
+                return
+
+    def _write_batch(self, records):
+        self._rotate_if_needed()
+        self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        self._file.flush()
+        now = time.monotonic()
+        if self.fsync == "always" or (self.fsync == "interval" and now - self._last_fsync >= 1.0):
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+        self.written += len(records)
+
+    def _rotate_if_needed(self):
+        if self._file is not None:
+            size = self._file.tell()
+            too_old = self.max_age and time.time() - self._opened_at >= self.max_age
+            if size < self.max_bytes and not (too_old and size):
+                return
+            self._file.close()
+            rotated = f"{self._file_path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+            os.replace(self._file_path, rotated)
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+            self._prune()
+        if self._file_path is None:
+            self._file_path = self._claim_file()
+        self._file = open(self._file_path, "a", encoding="utf-8")
+        self._opened_at = self._first_record_time() if self._file.tell() else time.time()
+
+    def _claim_file(self):
+        # Jede Datei hat genau einen schreibenden und rotierenden Prozess: weitere Worker-Prozesse belegen
+        # interactions.1.jsonl, interactions.2.jsonl, ... und finden ihre Datei nach einem Neustart wieder
+        try:
+            import fcntl
+        except ImportError:
+            return self.path
+        stem, extension = os.path.splitext(self.path)
+        for slot in itertools.count():
+            path = self.path if slot == 0 else f"{stem}.{slot}{extension}"
+            lock = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            self._slot_lock = lock
+            return path
+
+    def _first_record_time(self):
+        # st_ctime ist unter Linux die letzte Änderung, das Alter der Datei ergibt sich aus ihrem ersten Eintrag
+        try:
+            with open(self._file_path, encoding="utf-8") as f:
+                return datetime.fromisoformat(json.loads(f.readline())["ts"]).timestamp()
+        except (OSError, ValueError, KeyError):
+            return time.time()
+
+    def _prune(self):
+        directory = os.path.dirname(self._file_path) or "."
+        prefix = os.path.basename(self._file_path) + "."
+        rotated = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(".gz"))
+        for name in rotated[:-self.backups] if self.backups else rotated:
+            os.remove(os.path.join(directory, name))
+
+    def close(self, timeout=5):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+interaction_log = InteractionLog(
+    app.config["INTERACTION_LOG"],
+    app.config["INTERACTION_LOG_MAX_BYTES"],
+    app.config["INTERACTION_LOG_MAX_AGE"],
+    fsync=app.config["INTERACTION_LOG_FSYNC"],
+    backups=app.config["INTERACTION_LOG_BACKUPS"]
+)
+
+def reset_question_state(state):
+    state.current_question = ""
+
+def clean_question(question: str) -> str:
+    return question.strip().strip('\'"')
+
+def build_question_prompt(topic, language, count=1):
+    prompts = {
+        "de": f"Erzeuge eine einfache, natürliche Frage über {topic}, die ein Kunde, Patient oder Gesprächspartner stellen könnte. Die Frage soll konkret beantwortbar sein und natürlich formuliert.",
+        "en": f"Generate a single, direct question about {topic} that a customer, patient, or conversation partner might ask. The question should be phrased naturally and require a concrete answer.",
+        "fr": f"Génère une question simple et directe sur {topic} qu'un client, un patient ou un interlocuteur pourrait poser. La question doit être formulée naturellement et demander une réponse concrète."
+    }
+    candidates = {
+        "de": f" Gib {count} verschiedene solcher Fragen aus, jede in einer eigenen Zeile, ohne Nummerierung und ohne weitere Erklärungen.",
+        "en": f" Output {count} different questions of this kind, each on its own line, without numbering or any further explanation.",
+        "fr": f" Donne {count} questions différentes de ce type, chacune sur une ligne, sans numérotation ni autre explication."
+    }
+    prompt = prompts.get(language, prompts["de"])
+    if count > 1:
+        prompt += candidates.get(language, candidates["de"])
+    return prompt
+
+def parse_question_candidates(text):
+    candidates = []
+    for line in text.splitlines():
+        line = re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', line)
+        question = clean_question(line.replace("**", ""))
+        if question:
+            candidates.append(question)
+    questions = [candidate for candidate in candidates if candidate.endswith("?")]
+    return questions or candidates
+
+def generate_question_text(topic, language, asked_questions, shared=True, priority=LLM_PRIORITY_QUESTION):
+    question_prompt = build_question_prompt(topic, language, app.config["QUESTION_CANDIDATES"])
+    generate = generate_llm_shared if shared else _generate_llm
+    fallback = None
+    for _ in range(app.config["QUESTION_MAX_ATTEMPTS"]):
+        candidates = parse_question_candidates(generate(question_prompt, priority))
+        for candidate in candidates:
+            if candidate not in asked_questions:
+                return candidate
+        for candidate in candidates:
+            similarity = asked_questions.similarity(candidate)
+            if fallback is None or similarity < fallback[0]:
+                fallback = (similarity, candidate)
+    if fallback is None:
+        raise LLMRequestError("Das Modell hat keine Frage geliefert.")
+    app.logger.warning(
+        f"Keine neue Frage nach {app.config['QUESTION_MAX_ATTEMPTS']} Versuchen gefunden, "
+        f"verwende die unähnlichste (Ähnlichkeit {fallback[0]:.2f})."
+    )
+    return fallback[1]
+
+def register_question(state, question, topic, language, source="llm", llm_seconds=None):
+    reset_question_state(state)
+    state.question_count += 1
+    state.asked_questions.add(question)
+    state.current_question = question
+    interaction_log.write(
+        "question",
+        session_id=state.public_id,
+        question_number=state.question_count,
+        language=language,
+        topic=topic,
+        question=question,
+        source=source,
+        llm_seconds=llm_seconds
+    )
+    return state.current_question
+
+def generate_topic_question(topic, language, state):
+    if not topic or not topic.strip():
+        raise ValueError("Kein Thema angegeben.")
+    started = time.monotonic()
+    question = generate_question_text(topic, language, state.asked_questions)
+    return register_question(state, question, topic, language, llm_seconds=round(time.monotonic() - started, 3))
+
+class TTSCache:
+    def __init__(self, root, subdir, max_bytes):
+        self.subdir = subdir
+        self.folder = os.path.join(root, subdir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(text, voice, rate, pitch):
+        raw = json.dumps([text, voice, rate, pitch], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.mp3")
+
+    def _disk_size(self, key):
+        # Ein Eintrag umfasst das MP3 und seine transkodierte Variante (.webm)
+        size = os.path.getsize(self._path(key))
+        try:
+            size += os.path.getsize(self._path(key)[:-4] + ".webm")
+        except FileNotFoundError:
+            pass
+        return size
+
+    def _load(self):
+        found = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".mp3"):
+                found.append((entry.stat().st_mtime, entry.name[:-4]))
+            elif entry.name.endswith(".tmp") and time.time() - entry.stat().st_mtime > 3600:
+                # Reste abgebrochener Schreibvorgänge entfernen.
+                os.remove(entry.path)
+            elif entry.name.endswith(".webm") and not os.path.exists(entry.path[:-5] + ".mp3"):
+                os.remove(entry.path)
+        with self._lock:
+            for _, key in sorted(found):
+                try:
+                    size = self._disk_size(key)
+                except FileNotFoundError:
+                    continue
+                self._entries[key] = size
+                self._size += size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            # Transkodierte Varianten (.webm) verschwinden mit dem Original
+            for path in (self._path(key), self._path(key)[:-4] + ".webm"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                # Die mtime dient als LRU-Zeitstempel und überdauert so Neustarts.
+                os.utime(path)
+                size = self._disk_size(key)
+            except FileNotFoundError:
+                self._size -= self._entries.pop(key, 0)
+                self.misses += 1
+                return None
+            self._size += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return f"{self.subdir}/{key}.mp3"
+
+    def temp_path(self, key):
+        return os.path.join(self.folder, f"{key}.{uuid.uuid4().hex}.tmp")
+
+    def commit(self, key, temp_path):
+        # os.replace ist atomar, parallele Schreiber desselben Schlüssels überschreiben sich nur gegenseitig.
+        os.replace(temp_path, self._path(key))
+        with self._lock:
+            size = self._disk_size(key)
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return f"{self.subdir}/{key}.mp3"
+
+    def add_variant(self, key):
+        with self._lock:
+            if key not in self._entries:
+                # Das Original wurde während der Transkodierung verdrängt
+                try:
+                    os.remove(self._path(key)[:-4] + ".webm")
+                except FileNotFoundError:
+                    pass
+                return
+            try:
+                size = self._disk_size(key)
+            except FileNotFoundError:
+                return
+            self._size += size - self._entries[key]
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+tts_cache = TTSCache(app.config["UPLOAD_FOLDER"], "tts_cache", app.config["TTS_CACHE_MAX_BYTES"])
+
+class AudioStorage:
+    shared_bucket = "_shared"
+
+    def __init__(self, root, ttl, quota_bytes, interval):
+        self.root = root
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+        self.sessions_dir = os.path.join(root, "sessions")
+        self.trash_dir = os.path.join(root, ".trash")
+        self.evicted_sessions = 0
+        self.reclaimed_bytes = 0
+        self.usage_bytes = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        os.makedirs(self.trash_dir, exist_ok=True)
+
+    def _bucket(self, session_id):
+        return public_session_id(session_id) or self.shared_bucket
+
+    def session_file(self, session_id, filename):
+        bucket = self._bucket(session_id)
+        directory = os.path.join(self.sessions_dir, bucket)
+        os.makedirs(directory, exist_ok=True)
+        # Die mtime des Ordners markiert die letzte Aktivität der Sitzung.
+        os.utime(directory)
+        return os.path.join(directory, filename), f"sessions/{bucket}/{filename}"
+
+    def clear_session(self, session_id):
+        bucket = self._bucket(session_id)
+        if bucket == self.shared_bucket:
+            return
+        try:
+            os.replace(os.path.join(self.sessions_dir, bucket), os.path.join(self.trash_dir, f"{bucket}-{uuid.uuid4().hex}"))
+        except FileNotFoundError:
+            return
+        self._wake.set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audio-gc", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                app.logger.error(f"Aufräumen des Audiospeichers fehlgeschlagen: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    @staticmethod
+    def _tree_size(path):
+        total = 0
+        for directory, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def _discard(self, path):
+        size = self._tree_size(path) if os.path.isdir(path) else os.path.getsize(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        self.reclaimed_bytes += size
+
+    def collect(self):
+        for entry in os.scandir(self.trash_dir):
+            self._discard(entry.path)
+
+        now = time.time()
+        # Einzelne Dateien im Wurzelordner stammen aus älteren Versionen ohne Sitzungsordner.
+        for entry in os.scandir(self.root):
+            if entry.is_file() and now - entry.stat().st_mtime > self.ttl:
+                self._discard(entry.path)
+
+        sessions = []
+        for entry in os.scandir(self.sessions_dir):
+            if not entry.is_dir():
+                continue
+            modified = entry.stat().st_mtime
+            if now - modified > self.ttl:
+                self._discard(entry.path)
+                self.evicted_sessions += 1
+            else:
+                sessions.append((modified, entry.path, self._tree_size(entry.path)))
+
+        usage = sum(size for _, _, size in sessions)
+        for _, path, size in sorted(sessions):
+            if usage <= self.quota_bytes:
+                break
+            self._discard(path)
+            self.evicted_sessions += 1
+            usage -= size
+        self.usage_bytes = usage
+
+    def stats(self):
+        return {
+            "usage_bytes": self.usage_bytes,
+            "quota_bytes": self.quota_bytes,
+            "evicted_sessions": self.evicted_sessions,
+            "reclaimed_bytes": self.reclaimed_bytes
+        }
+
+audio_storage = AudioStorage(
+    app.config["UPLOAD_FOLDER"],
+    app.config["AUDIO_TTL"],
+    app.config["AUDIO_QUOTA_BYTES"],
+    app.config["AUDIO_GC_INTERVAL"]
+)
+
+async def _synthesize_to_cache(key, text, voice, rate, pitch):
+    import edge_tts
+    temp_path = tts_cache.temp_path(key)
+    try:
+        with stage_timer("tts"):
+            tts = edge_tts.Communicate(text, voice=voice, rate=rate, pitch=pitch)
+            await tts.save(temp_path)
+        return tts_cache.commit(key, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+async def convert_text_to_speech(text, prefix="ai_feedback", output_file=None, voice="en-US-JennyNeural", rate="+0%", pitch="+0Hz", session_id=None, cache=True):
+    import edge_tts
+    # Feedback gehört zur Sitzung (cache=False) und wird mit ihr gelöscht, nur Fragen landen im gemeinsamen Cache
+    if output_file is None and cache and tts_cache.max_bytes > 0:
+        key = TTSCache.key(text, voice, rate, pitch)
+        cached = tts_cache.get(key)
+        if cached:
+            return cached
+        return await tts_flight.do_async(key, _synthesize_to_cache, key, text, voice, rate, pitch)
+    if output_file is None:
+        output_file = f"{prefix}_{int(time.time())}_{uuid.uuid4().hex[:8]}.mp3"
+    output_path, relative_path = audio_storage.session_file(session_id, output_file)
+    with stage_timer("tts"):
+        tts = edge_tts.Communicate(text, voice=voice, rate=rate, pitch=pitch)
+        await tts.save(output_path)
+    return relative_path
+
+tts_slots = asyncio.Semaphore(app.config["TTS_CONCURRENCY"])
+
+class SentenceSplitter:
+    boundary = re.compile(r'(?<=[^\d\s][.!?])\s+|\n+')
+
+    def __init__(self, min_chars=40):
+        self.min_chars = min_chars
+        self.buffer = ""
+        self.pending = ""
+
+    def _collect(self, pieces):
+        sentences = []
+        for piece in pieces:
+            piece = piece.strip()
+            if not piece:
+                continue
+            self.pending = f"{self.pending} {piece}" if self.pending else piece
+            if len(self.pending) >= self.min_chars:
+                sentences.append(self.pending)
+                self.pending = ""
+        return sentences
+
+    def feed(self, text):
+        self.buffer += text
+        pieces = self.boundary.split(self.buffer)
+        self.buffer = pieces.pop()
+        return self._collect(pieces)
+
+    def flush(self):
+        sentences = self._collect([self.buffer])
+        self.buffer = ""
+        if self.pending:
+            sentences.append(self.pending)
+            self.pending = ""
+        return sentences
+
+class SpeechPipeline:
+    def __init__(self, voice, prefix, session_id=None):
+        self.voice = voice
+        self.prefix = prefix
+        self.session_id = session_id
+        self.jobs = []
+        self.emitted = 0
+
+    async def _synthesize(self, text, index):
+        async with tts_slots:
+            return await convert_text_to_speech(
+                text, f"{self.prefix}_{index}", voice=self.voice, session_id=self.session_id, cache=False
+            )
+
+    def submit(self, sentence):
+        text = " ".join(sentence.split())
+        if text:
+            self.jobs.append(async_runtime.submit(self._synthesize(text, len(self.jobs))))
+
+    def _take(self, wait):
+        while self.emitted < len(self.jobs):
+            job = self.jobs[self.emitted]
+            if not wait and not job.done():
+                break
+            index = self.emitted
+            self.emitted += 1
+            try:
+                yield index, job.result()
+            except Exception as e:
+                app.logger.error(f"Sprachsynthese für Satz {index} fehlgeschlagen: {e}")
+
+    def ready(self):
+        return self._take(wait=False)
+
+    def drain(self):
+        return self._take(wait=True)
+
+def clear_all(state):
+    try:
+        audio_storage.clear_session(state.session_id)
+    except Exception as e:
+        app.logger.error(f"Fehler beim Löschen der Audiodateien der Sitzung: {e}")
+    state.question_count = 0
+    state.current_question = ""
+    state.asked_questions = QuestionIndex(app.config["QUESTION_INDEX_CAPACITY"], app.config["QUESTION_SIMILARITY"])
+    state.conversation, state.conversation_language = [], ""
+    return "", "", ""
+
+QUESTION_VOICES = {
+    "de": "de-DE-KatjaNeural",
+    "en": "en-US-JennyNeural",
+    "fr": "fr-FR-DeniseNeural"
+}
+
+class QuestionPrefetcher:
+    def __init__(self, pool_size, concurrency, max_topics):
+        self.pool_size = pool_size
+        self.max_topics = max_topics
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failures = 0
+        self._pools = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="prefetch")
+
+    @staticmethod
+    def _key(topic, language):
+        return " ".join(topic.lower().split()), language
+
+    def take(self, topic, language, asked_questions):
+        key = self._key(topic, language)
+        item = None
+        with self._lock:
+            pool = self._pools.get(key, ())
+            for candidate in list(pool):
+                audio_path = os.path.join(app.config["UPLOAD_FOLDER"], candidate["audio"])
+                if candidate["question"] in asked_questions:
+                    continue
+                pool.remove(candidate)
+                if os.path.exists(audio_path):
+                    item = candidate
+                    break
+            if item:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.refill(topic, language)
+        return item
+
+    def refill(self, topic, language):
+        key = self._key(topic, language)
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            self._pools.move_to_end(key)
+            while len(self._pools) > self.max_topics:
+                self._pools.popitem(last=False)
+            pending = self._pending.get(key, 0)
+            missing = max(0, self.pool_size - len(pool) - pending)
+            self._pending[key] = pending + missing
+        for _ in range(missing):
+            self._executor.submit(self._fill, topic, language, key)
+
+    def _fill(self, topic, language, key):
+        try:
+            with self._lock:
+                pooled = QuestionIndex.from_list(
+                    [item["question"] for item in self._pools.get(key, ())], threshold=app.config["QUESTION_SIMILARITY"]
+                )
+            # Ohne Bündelung, sonst lieferten parallele Füllaufträge dieselben Kandidaten
+            question = generate_question_text(topic, language, pooled, shared=False, priority=LLM_PRIORITY_PREFETCH)
+            voice = QUESTION_VOICES.get(language, "en-US-JennyNeural")
+            audio_file = async_runtime.run(convert_text_to_speech(question, "customer_question", voice=voice))
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is not None and question not in QuestionIndex.from_list(
+                    [item["question"] for item in pool], threshold=app.config["QUESTION_SIMILARITY"]
+                ):
+                    pool.append({"question": question, "audio": audio_file})
+                    self.generated += 1
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            app.logger.error(f"Vorab-Erzeugung einer Frage zu '{topic}' fehlgeschlagen: {e}")
+        finally:
+            with self._lock:
+                remaining = self._pending.get(key, 1) - 1
+                if remaining > 0:
+                    self._pending[key] = remaining
+                else:
+                    self._pending.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "topics": len(self._pools),
+                "pooled": sum(len(pool) for pool in self._pools.values()),
+                "pending": sum(self._pending.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "generated": self.generated,
+                "failures": self.failures
+            }
+
+question_prefetcher = None
+if app.config["PREFETCH_POOL_SIZE"] > 0:
+    question_prefetcher = QuestionPrefetcher(
+        app.config["PREFETCH_POOL_SIZE"], app.config["PREFETCH_CONCURRENCY"], app.config["PREFETCH_MAX_TOPICS"]
+    )
+
+async def start_process(topic, language, state):
+    if question_prefetcher is not None:
+        item = question_prefetcher.take(topic, language, state.asked_questions)
+        if item:
+            register_question(state, item["question"], topic, language, source="prefetch")
+            return item
+    question = await run_blocking(generate_topic_question, topic, language, state)
+    voice = QUESTION_VOICES.get(language, "en-US-JennyNeural")
+    audio_file = await convert_text_to_speech(
+        question, f"customer_question_{state.question_count}", voice=voice, session_id=state.session_id
+    )
+    return {"question": question, "audio": audio_file}
+
+class ASRBackend:
+    name = None
+
+    def __init__(self, model_size, device=None, threads=0, compute_type="int8"):
+        self.model_size = model_size
+        self.device = device
+        self.threads = threads
+        self.compute_type = compute_type
+        self.model = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def transcribe(self, audio, language):
+        raise NotImplementedError
+
+    def transcribe_many(self, audios, language):
+        results = []
+        for audio in audios:
+            try:
+                results.append((True, self.transcribe(audio, language)["text"]))
+            except Exception as e:
+                results.append((False, str(e)))
+        return results
+
+class OpenAIWhisperBackend(ASRBackend):
+    name = "whisper"
+
+    def load(self):
+        import whisper
+        if self.threads:
+            import torch
+            torch.set_num_threads(self.threads)
+        self.model = whisper.load_model(self.model_size, device=self.device)
+        return self
+
+    def transcribe(self, audio, language):
+        result = self.model.transcribe(audio, language=language)
+        return {
+            "text": result.get("text", "").strip(),
+            "segments": [
+                {"start": segment["start"], "end": segment["end"], "text": segment["text"].strip()}
+                for segment in result.get("segments", [])
+            ]
+        }
+
+    def transcribe_many(self, audios, language):
+        import torch, whisper
+        results = [None] * len(audios)
+        clips = []
+        for index, audio in enumerate(audios):
+            try:
+                audio = whisper.load_audio(audio) if isinstance(audio, str) else audio
+            except Exception as e:
+                results[index] = (False, str(e))
+                continue
+            if audio.shape[0] <= whisper.audio.N_SAMPLES:
+                clips.append((index, audio))
+            else:
+                results[index] = super().transcribe_many([audio], language)[0]
+
+        # Clips bis 30 s passen in ein Whisper-Fenster und werden gemeinsam dekodiert.
+        if len(clips) > 1:
+            try:
+                mel = torch.stack([
+                    whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), self.model.dims.n_mels)
+                    for _, audio in clips
+                ]).to(self.model.device)
+                options = whisper.DecodingOptions(
+                    language=language, without_timestamps=True, fp16=self.model.device.type == "cuda"
+                )
+                for (index, _), decoded in zip(clips, whisper.decode(self.model, mel, options)):
+                    results[index] = (True, decoded.text.strip())
+                clips = []
+            except Exception as e:
+                app.logger.warning(f"Batch-Dekodierung fehlgeschlagen, transkribiere einzeln: {e}")
+        outcomes = super().transcribe_many([audio for _, audio in clips], language)
+        for (index, _), outcome in zip(clips, outcomes):
+            results[index] = outcome
+        return results
+
+class FasterWhisperBackend(ASRBackend):
+    name = "faster-whisper"
+
+    def load(self):
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(
+            self.model_size,
+            device=self.device or "auto",
+            compute_type=self.compute_type,
+            cpu_threads=self.threads
+        )
+        return self
+
+    def transcribe(self, audio, language):
+        segments, _ = self.model.transcribe(audio, language=language, beam_size=5)
+        segments = [{"start": segment.start, "end": segment.end, "text": segment.text.strip()} for segment in segments]
+        return {"text": " ".join(segment["text"] for segment in segments).strip(), "segments": segments}
+
+ASR_BACKENDS = {
+    OpenAIWhisperBackend.name: OpenAIWhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend
+}
+
+def parse_model_sizes(value):
+    sizes = {}
+    for item in value.split(","):
+        if ":" in item:
+            language, size = item.split(":", 1)
+            sizes[language.strip()] = size.strip()
+    return sizes
+
+def asr_settings(threads=0):
+    return {
+        "engine": app.config["ASR_ENGINE"],
+        "model_size": app.config["WHISPER_MODEL"],
+        "model_sizes": parse_model_sizes(app.config["WHISPER_MODEL_SIZES"]),
+        "device": app.config["ASR_DEVICE"],
+        "compute_type": app.config["ASR_COMPUTE_TYPE"],
+        "threads": threads
+    }
+
+asr_backends = {}
+asr_backends_lock = threading.Lock()
+_worker_asr_settings = None
+
+def get_asr_backend(language, settings=None):
+    settings = settings or _worker_asr_settings or asr_settings()
+    size = settings["model_sizes"].get(language, settings["model_size"])
+    key = (settings["engine"], size, settings["device"], settings["compute_type"])
+    with asr_backends_lock:
+        backend = asr_backends.get(key)
+        if backend is None:
+            backend_class = ASR_BACKENDS[settings["engine"]]
+            backend = backend_class(
+                size, device=settings["device"], threads=settings["threads"], compute_type=settings["compute_type"]
+            ).load()
+            asr_backends[key] = backend
+        return backend
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".webm", ".ogg", ".m4a", ".flac")
+
+def load_audio_16k(path):
+    import numpy as np
+    process = subprocess.run(
+        ["ffmpeg", "-nostdin", "-i", path, "-f", "s16le", "-ac", "1", "-ar", "16000", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True
+    )
+    return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+
+def _decode_with_pyav(data):
+    import av
+    import numpy as np
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+    chunks = []
+    with av.open(io.BytesIO(data), mode="r") as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+        for resampled in resampler.resample(None):
+            chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, np.float32)
+    return np.concatenate(chunks).astype(np.float32) / 32768.0
+
+def _decode_with_ffmpeg_pipe(data):
+    import numpy as np
+    process = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", "16000", "pipe:1"],
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if process.returncode == 0 and process.stdout:
+        return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+    # Container wie MP4 mit moov-Atom am Ende lassen sich nicht aus einer Pipe lesen
+    with tempfile.NamedTemporaryFile(suffix=".audio") as handle:
+        handle.write(data)
+        handle.flush()
+        try:
+            return load_audio_16k(handle.name)
+        except subprocess.CalledProcessError as e:
+            raise TranscriptionError(
+                f"Audio konnte nicht dekodiert werden: {e.stderr.decode(errors='replace').strip()}"
+            ) from e
+
+def detect_speech_segments(audio, threshold_db, min_silence_ms, padding_ms, max_segment_seconds, frame_ms=30, min_speech_ms=150):
+    import numpy as np
+    frame = 16000 * frame_ms // 1000
+    count = len(audio) // frame
+    if count == 0:
+        return []
+    frames = audio[:count * frame].reshape(count, frame)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    # Schwelle relativ zum Rauschboden, aber nie über Spitze - 30 dB und nie unter -50 dBFS
+    threshold = max(min(np.percentile(energy, 10) + threshold_db, energy.max() - 30), -50.0)
+    voiced = energy > threshold
+
+    max_gap = max(1, min_silence_ms // frame_ms)
+    runs, start, end = [], None, 0
+    for index, is_voiced in enumerate(voiced):
+        if is_voiced:
+            if start is None:
+                start = index
+            end = index + 1
+        elif start is not None and index - end >= max_gap:
+            runs.append((start, end))
+            start = None
+    if start is not None:
+        runs.append((start, end))
+
+    padding = padding_ms // frame_ms
+    spans = []
+    for start, end in runs:
+        if (end - start) * frame_ms < min_speech_ms:
+            continue
+        start, end = max(0, start - padding), min(count, end + padding)
+        if spans and start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+
+    # Lange Abschnitte an der leisesten Stelle teilen, damit jedes Stück in ein Whisper-Fenster passt
+    max_frames = max(2, int(max_segment_seconds * 1000 // frame_ms))
+    segments = []
+    for start, end in spans:
+        while end - start > max_frames:
+            low = start + max_frames // 2
+            cut = low + int(np.argmin(energy[low:start + max_frames]))
+            segments.append((start, cut))
+            start = cut
+        segments.append((start, end))
+    last = len(audio)
+    return [(start * frame, last if end == count else end * frame) for start, end in segments]
+
+def fluency_metrics(segments, duration, text):
+    speech = sum(segment["end"] - segment["start"] for segment in segments)
+    pauses = [current["start"] - previous["end"] for previous, current in zip(segments, segments[1:])]
+    words = len(text.split())
+    return {
+        "duration_seconds": round(duration, 2),
+        "speech_seconds": round(speech, 2),
+        "speech_ratio": round(speech / duration, 3) if duration else 0.0,
+        "leading_silence_seconds": round(segments[0]["start"], 2) if segments else round(duration, 2),
+        "trailing_silence_seconds": round(duration - segments[-1]["end"], 2) if segments else 0.0,
+        "pause_count": len(pauses),
+        "mean_pause_seconds": round(sum(pauses) / len(pauses), 2) if pauses else 0.0,
+        "longest_pause_seconds": round(max(pauses), 2) if pauses else 0.0,
+        "words_per_minute": round(60 * words / speech, 1) if speech else 0.0
+    }
+
+def decode_audio_bytes(data):
+    try:
+        import av  # noqa: F401
+    except ImportError:
+        return _decode_with_ffmpeg_pipe(data)
+    try:
+        return _decode_with_pyav(data)
+    except Exception as e:
+        app.logger.warning(f"PyAV-Dekodierung fehlgeschlagen, nutze ffmpeg: {e}")
+        return _decode_with_ffmpeg_pipe(data)
+
+def word_error_rate(reference, hypothesis):
+    reference = re.sub(r"[^\w\s']", " ", reference.lower()).split()
+    hypothesis = re.sub(r"[^\w\s']", " ", hypothesis.lower()).split()
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1] / len(reference)
+
+def run_asr_benchmark(audio_dir, engines, sizes, language):
+    samples = []
+    for name in sorted(os.listdir(audio_dir)):
+        stem, extension = os.path.splitext(name)
+        if extension.lower() not in AUDIO_EXTENSIONS:
+            continue
+        reference_path = os.path.join(audio_dir, stem + ".txt")
+        reference = None
+        if os.path.exists(reference_path):
+            with open(reference_path, encoding="utf-8") as f:
+                reference = f.read().strip()
+        samples.append((name, load_audio_16k(os.path.join(audio_dir, name)), reference))
+    if not samples:
+        raise SystemExit(f"Keine Audiodateien in {audio_dir} gefunden.")
+    audio_seconds = sum(len(audio) for _, audio, _ in samples) / 16000
+
+    results = []
+    for engine in engines:
+        for size in sizes:
+            settings = dict(asr_settings(), engine=engine, model_size=size, model_sizes={})
+            started = time.perf_counter()
+            try:
+                backend = get_asr_backend(language, settings)
+            except ImportError as e:
+                print(f"{engine}/{size}: übersprungen ({e})")
+                continue
+            load_seconds = time.perf_counter() - started
+            backend.transcribe(samples[0][1][:16000], language)
+
+            elapsed = 0.0
+            errors = []
+            for name, audio, reference in samples:
+                started = time.perf_counter()
+                text = backend.transcribe(audio, language)["text"]
+                elapsed += time.perf_counter() - started
+                if reference is not None:
+                    errors.append(word_error_rate(reference, text))
+            results.append({
+                "engine": engine,
+                "model_size": size,
+                "files": len(samples),
+                "audio_seconds": audio_seconds,
+                "load_seconds": load_seconds,
+                "processing_seconds": elapsed,
+                "rtf": elapsed / audio_seconds if audio_seconds else 0.0,
+                "wer": sum(errors) / len(errors) if errors else None
+            })
+
+    print(f"{'Engine':<16}{'Modell':<10}{'Laden [s]':>10}{'Audio [s]':>11}{'Rechenzeit [s]':>16}{'RTF':>8}{'WER':>8}")
+    for row in results:
+        wer = f"{row['wer']:.3f}" if row["wer"] is not None else "-"
+        print(
+            f"{row['engine']:<16}{row['model_size']:<10}{row['load_seconds']:>10.1f}{row['audio_seconds']:>11.1f}"
+            f"{row['processing_seconds']:>16.1f}{row['rtf']:>8.3f}{wer:>8}"
+        )
+    return results
+
+class TranscriptionError(Exception):
+    pass
+
+class TranscriptionQueueFull(Exception):
+    pass
+
+def _init_transcription_worker(settings):
+    global _worker_asr_settings
+    _worker_asr_settings = settings
+    get_asr_backend(None)
+
+def _transcribe_batch(jobs):
+    results = [None] * len(jobs)
+    languages = {}
+    for index, (_, language) in enumerate(jobs):
+        languages.setdefault(language, []).append(index)
+    for language, indices in languages.items():
+        try:
+            outcomes = get_asr_backend(language).transcribe_many([jobs[i][0] for i in indices], language)
+        except Exception as e:
+            outcomes = [(False, str(e))] * len(indices)
+        for index, outcome in zip(indices, outcomes):
+            results[index] = outcome
+    return results
+
+class TranscriptionService:
+    def __init__(self, workers, settings, queue_size, batch_size, batch_window):
+        self.workers = workers
+        self.settings = settings
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue_size = queue_size
+        self.completed = 0
+        self.batches = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._wait_times = deque(maxlen=256)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._slots = threading.Semaphore(workers)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = self._create_executor()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="whisper-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_transcription_worker,
+            initargs=(self.settings,)
+        )
+
+    def _restart(self, broken):
+        # Stirbt ein Worker (z.B. durch den OOM-Killer), ist der ganze Pool unbrauchbar und wird ersetzt
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self.restarts += 1
+            self._executor = self._create_executor()
+        app.logger.error("Ein Transkriptionsprozess ist abgestürzt, der Prozesspool wurde neu gestartet.")
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, audio_path, language):
+        future = Future()
+        try:
+            self._queue.put_nowait((audio_path, language, future, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise TranscriptionQueueFull("Die Transkriptionswarteschlange ist voll.")
+        return future
+
+    def transcribe(self, audio_path, language, timeout=None):
+        return self.submit(audio_path, language).result(timeout=timeout)
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            with self._lock:
+                self._wait_times.extend(now - enqueued for _, _, _, enqueued in batch)
+                self._in_flight += len(batch)
+                self.batches += 1
+            jobs = [(path, language) for path, language, _, _ in batch]
+            executor = self._executor
+            try:
+                try:
+                    task = executor.submit(_transcribe_batch, jobs)
+                except BrokenProcessPool:
+                    self._restart(executor)
+                    executor = self._executor
+                    task = executor.submit(_transcribe_batch, jobs)
+            except Exception as e:
+                self._finish(batch, error=e)
+                continue
+            task.add_done_callback(lambda task, batch=batch, executor=executor: self._complete(task, batch, executor))
+
+    def _complete(self, task, batch, executor):
+        try:
+            results = task.result()
+        except BrokenProcessPool as e:
+            # Nur die Stapel, die im abgestürzten Pool liefen, schlagen fehl
+            self._restart(executor)
+            self._finish(batch, error=TranscriptionError(f"Transkriptionsprozess abgestürzt: {e}"))
+        except Exception as e:
+            self._finish(batch, error=e)
+        else:
+            self._finish(batch, results=results)
+
+    def _finish(self, batch, results=None, error=None):
+        with self._lock:
+            self._in_flight -= len(batch)
+            self.completed += len(batch)
+        self._slots.release()
+        for position, (_, _, future, _) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+                continue
+            ok, value = results[position]
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(TranscriptionError(value))
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._wait_times)
+            return {
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self.queue_size,
+                "in_flight": self._in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "restarts": self.restarts,
+                "avg_batch_size": self.completed / self.batches if self.batches else 0.0,
+                "avg_wait_ms": 1000 * sum(waits) / len(waits) if waits else 0.0,
+                "max_wait_ms": 1000 * max(waits) if waits else 0.0
+            }
+
+    def worker_pids(self):
+        return list(getattr(self._executor, "_processes", None) or ())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+transcription_service = None
+transcription_service_lock = threading.Lock()
+
+def get_transcription_service():
+    global transcription_service
+    with transcription_service_lock:
+        if transcription_service is None:
+            transcription_service = TranscriptionService(
+                app.config["WHISPER_WORKERS"],
+                asr_settings(threads=app.config["WHISPER_TORCH_THREADS"]),
+                app.config["WHISPER_QUEUE_SIZE"],
+                app.config["WHISPER_BATCH_SIZE"],
+                app.config["WHISPER_BATCH_WINDOW_MS"] / 1000
+            )
+        return transcription_service
+
+def _warm_transcription_worker(languages):
+    for language in languages:
+        get_asr_backend(language)
+    return os.getpid()
 
-logging.basicConfig(level=logging.DEBUG)
+def warm_up_asr():
+    languages = [None] + sorted(parse_model_sizes(app.config["WHISPER_MODEL_SIZES"]))
+    if app.config["WHISPER_WORKERS"] > 0:
+        service = get_transcription_service()
+        tasks = [service._executor.submit(_warm_transcription_worker, languages) for _ in range(service.workers)]
+        for task in tasks:
+            task.result()
+    else:
+        _warm_transcription_worker(languages)
 
-whisper_model = whisper.load_model("base")
+def warm_up_llm():
+    if app.config["LLM_BACKEND"] != "http" or not app.config["WARMUP_LLM"]:
+        return "skipped"
+    ollama_client.generate("")
 
-question_count = 0
-current_question = ""
-asked_questions = set()
+class ModelWarmup:
+    asr_retry_seconds = 60
 
-def query_llm_via_ollama(input_text):
-    try:
-        process = subprocess.run(
-            ["ollama", "run", "llama3.2"],
-            input=input_text,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8',
-            timeout=40
-        )
-        if process.returncode != 0:
-            return f"Fehler bei der Modellanfrage: {process.stderr.strip()}"
-        response = re.sub(r'\x1b\[.*?m', '', process.stdout)
-        return response.strip()
-    except subprocess.TimeoutExpired:
-        return "Zeitüberschreitung bei der Modellanfrage."
-    except Exception as e:
-        return f"Ein unerwarteter Fehler ist aufgetreten: {str(e)}"
+    def __init__(self):
+        self.status = {"asr": "pending", "llm": "pending"}
+        self.timings = {}
+        self.asr_ready = threading.Event()
+        self.failed_at = {}
+        self._thread = None
+        self._lock = threading.Lock()
 
-def markdown_to_text(md):
-    html = markdown.markdown(md)
-    soup = BeautifulSoup(html, "html.parser")
-    text = soup.get_text(separator='\n')
-    return text.strip()
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="model-warmup", daemon=True)
+                self._thread.start()
 
-def save_to_file(filename, content):
-    with open(filename, "a") as f:
-        f.write(content + "\n")
+    def _step(self, name, func):
+        started = time.monotonic()
+        try:
+            self.status[name] = func() or "ready"
+        except Exception as e:
+            # Zeitpunkt und Status gemeinsam setzen, asr_error darf keinen Fehler ohne Zeitpunkt sehen
+            with self._lock:
+                self.failed_at[name] = time.monotonic()
+                self.status[name] = f"error: {e}"
+            app.logger.error(f"Aufwärmen von {name} fehlgeschlagen: {e}")
+        self.timings[name] = round(time.monotonic() - started, 3)
 
-def reset_question_state():
-    global current_question
-    current_question = ""
+    def _load_asr(self):
+        self._step("asr", warm_up_asr)
+        if self.status["asr"] == "ready":
+            self.asr_ready.set()
 
-def clean_question(question: str) -> str:
-    return question.strip().strip('\'"')
+    def asr_error(self):
+        # Ein fehlgeschlagenes Laden wird mit dem Fehler gemeldet und frühestens nach asr_retry_seconds wiederholt
+        status = self.status["asr"]
+        if not status.startswith("error"):
+            return None
+        with self._lock:
+            if self.status["asr"] == status and time.monotonic() - self.failed_at["asr"] >= self.asr_retry_seconds:
+                self.status["asr"] = "pending"
+                threading.Thread(target=self._load_asr, name="asr-retry", daemon=True).start()
+        return status.removeprefix("error: ")
 
-def generate_topic_question(topic, language):
-    if not topic or not topic.strip():
-        raise ValueError("Kein Thema angegeben.")
-    global question_count, current_question, asked_questions
-    reset_question_state()
-    question_count += 1
+    def _run(self):
+        llm_thread = threading.Thread(target=self._step, args=("llm", warm_up_llm), name="llm-warmup", daemon=True)
+        llm_thread.start()
+        self._load_asr()
+        llm_thread.join()
+        self.timings["total_since_start"] = round(time.monotonic() - STARTUP_STARTED, 3)
+        app.logger.info(
+            f"Startzeit: Spracherkennung {self.timings['asr']:.1f} s, Sprachmodell {self.timings['llm']:.1f} s, "
+            f"bereit nach {self.timings['total_since_start']:.1f} s seit Prozessstart"
+        )
 
-    prompts = {
-        "de": f"Erzeuge eine einfache, natürliche Frage über {topic}, die ein Kunde, Patient oder Gesprächspartner stellen könnte. Die Frage soll konkret beantwortbar sein und natürlich formuliert.",
-        "en": f"Generate a single, direct question about {topic} that a customer, patient, or conversation partner might ask. The question should be phrased naturally and require a concrete answer.",
-        "fr": f"Génère une question simple et directe sur {topic} qu'un client, un patient ou un interlocuteur pourrait poser. La question doit être formulée naturellement et demander une réponse concrète."
-    }
+    @property
+    def ready(self):
+        return self.asr_ready.is_set() and self.status["llm"] != "pending"
 
-    question_prompt = prompts.get(language, prompts["de"])
+model_warmup = ModelWarmup()
 
-    while True:
-        generated_question = query_llm_via_ollama(question_prompt)
-        cleaned_question = clean_question(generated_question)
-        if cleaned_question not in asked_questions:
-            asked_questions.add(cleaned_question)
-            current_question = cleaned_question
-            break 
+def transcribe_audio_whisper(audio, language):
+    try:
+        with stage_timer("whisper"):
+            if app.config["WHISPER_WORKERS"] > 0:
+                return get_transcription_service().transcribe(
+                    audio, language, timeout=app.config["WHISPER_TIMEOUT"]
+                )
+            else:
+                return get_asr_backend(language).transcribe(audio, language)["text"]
+    except TranscriptionQueueFull:
+        raise
+    except Exception as e:
+        app.logger.error(f"Whisper Transkriptionsfehler: {e}")
+        raise TranscriptionError(f"Fehler bei der Transkription: {str(e)}") from e
 
-    save_to_file("questions_log.txt", f"Frage {question_count}: {current_question}")
-    return current_question
+def transcribe_clips(clips, language):
+    with stage_timer("whisper"):
+        return _transcribe_clips(clips, language)
 
-async def convert_text_to_speech(text, prefix="ai_feedback", output_file=None, voice="en-US-JennyNeural"):
-    if output_file is None:
-        output_file = f"{prefix}_{question_count}_{int(time.time())}.mp3"
-    output_path = os.path.join(app.config["UPLOAD_FOLDER"], output_file)
-    import edge_tts
-    tts = edge_tts.Communicate(text, voice=voice)
-    await tts.save(output_path)
-    return output_file 
-
-def clear_all():
-    global question_count, current_question, asked_questions
-    for filename in os.listdir(app.config["UPLOAD_FOLDER"]):
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        try:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            app.logger.error(f"Fehler beim Löschen der Datei {filename}: {e}")
-    question_count = 0
-    current_question = ""
-    asked_questions = set()
-    return "", "", ""
+def _transcribe_clips(clips, language):
+    if app.config["WHISPER_WORKERS"] > 0:
+        service = get_transcription_service()
+        futures = [service.submit(clip, language) for clip in clips]
+        return [future.result(timeout=app.config["WHISPER_TIMEOUT"]) for future in futures]
+    texts = []
+    for ok, value in get_asr_backend(language).transcribe_many(clips, language):
+        if not ok:
+            raise TranscriptionError(value)
+        texts.append(value)
+    return texts
 
-async def start_process(topic, language):
-    question = generate_topic_question(topic, language)
-    voice_map = {
-        "de": "de-DE-KatjaNeural",
-        "en": "en-US-JennyNeural",
-        "fr": "fr-FR-DeniseNeural"
-    }
-    voice = voice_map.get(language, "en-US-JennyNeural")
-    audio_file = await convert_text_to_speech(question, f"customer_question_{question_count}", voice=voice)
-    return {"question": question, "audio": audio_file}
+def transcribe_answer(audio, language):
+    duration = len(audio) / 16000
+    if not app.config["VAD_ENABLED"]:
+        text = transcribe_audio_whisper(audio, language)
+        return {"text": text or "Keine Erkennung möglich.", "empty": not text, "segments": [], "fluency": None}
 
-def transcribe_audio_whisper(audio_file_path, language):
+    started = time.monotonic()
+    with stage_timer("vad"):
+        spans = detect_speech_segments(
+            audio,
+            app.config["VAD_THRESHOLD_DB"],
+            app.config["VAD_MIN_SILENCE_MS"],
+            app.config["VAD_PADDING_MS"],
+            app.config["VAD_MAX_SEGMENT_SECONDS"]
+        )
     try:
-        result = whisper_model.transcribe(audio_file_path, language=language)
-        transcription = result.get("text", "").strip()
-        return transcription if transcription else "Keine Erkennung möglich."
+        texts = transcribe_clips([audio[start:end] for start, end in spans], language) if spans else []
+    except TranscriptionQueueFull:
+        raise
     except Exception as e:
         app.logger.error(f"Whisper Transkriptionsfehler: {e}")
-        return f"Fehler bei der Transkription: {str(e)}"
+        raise TranscriptionError(f"Fehler bei der Transkription: {str(e)}") from e
+
+    segments = [
+        {"start": round(start / 16000, 2), "end": round(end / 16000, 2), "text": text.strip()}
+        for (start, end), text in zip(spans, texts)
+    ]
+    text = " ".join(segment["text"] for segment in segments if segment["text"])
+    speech = sum(end - start for start, end in spans) / 16000
+    app.logger.debug(
+        f"VAD: {len(spans)} Segmente, {speech:.1f} von {duration:.1f} s Sprache, "
+        f"Transkription in {time.monotonic() - started:.2f} s"
+    )
+    return {
+        "text": text or "Keine Erkennung möglich.",
+        "empty": not text,
+        "segments": segments,
+        "fluency": fluency_metrics(segments, duration, text)
+    }
+
+class LiveTranscriber:
+    # Erwartet 16-kHz-Mono-PCM (int16) in beliebig großen Stücken
+    def __init__(self, language, session_id=None):
+        import numpy as np
+        self.language = language
+        self.session_id = session_id
+        self.step = int(app.config["LIVE_STEP_MS"] * 16)
+        self.max_samples = int(app.config["LIVE_MAX_SECONDS"] * 16000)
+        self.silence = app.config["VAD_MIN_SILENCE_MS"] * 16
+        self.buffer = np.zeros(0, np.float32)
+        self.offset = 0
+        self.received = 0
+        self.pending = 0
+        self.segments = []
+        self.hypothesis = []
+        self.stable = 0
+
+    def handle(self, message):
+        try:
+            if isinstance(message, (bytes, bytearray)):
+                return self.feed(message), False
+            if json.loads(message).get("type") == "stop":
+                return self.finish(), True
+        except TranscriptionQueueFull as e:
+            return {"type": "error", "error": str(e)}, True
+        except (TranscriptionError, ValueError) as e:
+            return {"type": "error", "error": str(e)}, True
+        return None, False
+
+    def feed(self, data):
+        import numpy as np
+        samples = np.frombuffer(bytes(data[:len(data) // 2 * 2]), np.int16).astype(np.float32) / 32768.0
+        self.received += len(samples)
+        if self.received > self.max_samples:
+            raise TranscriptionError("Die Aufnahme ist zu lang für die Live-Transkription.")
+        self.buffer = np.concatenate([self.buffer, samples])
+        self.pending += len(samples)
+        if self.pending < self.step:
+            return None
+        self.pending = 0
+        try:
+            self._decode(final=False)
+        except TranscriptionQueueFull:
+            # Zwischenstand auslassen, beim nächsten Schritt erneut versuchen
+            return None
+        return {
+            "type": "partial",
+            "committed": self.committed_text(),
+            "stable": " ".join(self.hypothesis[:self.stable]),
+            "tentative": " ".join(self.hypothesis[self.stable:])
+        }
+
+    def finish(self):
+        self._decode(final=True)
+        text = self.committed_text()
+        fluency = fluency_metrics(self.segments, self.received / 16000, text)
+        interaction_log.write(
+            "transcription",
+            session_id=self.session_id,
+            language=self.language,
+            source="live",
+            segments=len(self.segments),
+            **fluency
+        )
+        return {
+            "type": "final",
+            "transcription": text or "Keine Erkennung möglich.",
+            "segments": self.segments,
+            "fluency": fluency
+        }
+
+    def committed_text(self):
+        return " ".join(segment["text"] for segment in self.segments if segment["text"])
+
+    def _decode(self, final):
+        spans = detect_speech_segments(
+            self.buffer,
+            app.config["VAD_THRESHOLD_DB"],
+            app.config["VAD_MIN_SILENCE_MS"],
+            app.config["VAD_PADDING_MS"],
+            app.config["VAD_MAX_SEGMENT_SECONDS"]
+        )
+        # Abschnitte gelten als abgeschlossen, sobald eine Pause folgt; nur der offene Rest wird erneut dekodiert
+        closed = spans if final else [
+            span for index, span in enumerate(spans)
+            if index < len(spans) - 1 or span[1] <= len(self.buffer) - self.silence
+        ]
+        tail = spans[len(closed)][0] if len(spans) > len(closed) else None
+        clips = [self.buffer[start:end] for start, end in closed]
+        if tail is not None:
+            clips.append(self.buffer[tail:])
+        texts = transcribe_clips(clips, self.language) if clips else []
+
+        for (start, end), text in zip(closed, texts):
+            self.segments.append({
+                "start": round((self.offset + start) / 16000, 2),
+                "end": round((self.offset + end) / 16000, 2),
+                "text": text.strip()
+            })
+        words = texts[-1].split() if tail is not None else []
+        if closed:
+            self.hypothesis = []
+        # Lokale Übereinstimmung: Wörter, die zwei Dekodierungen in Folge gleich liefern, gelten als stabil
+        self.stable = 0
+        for previous, current in zip(self.hypothesis, words):
+            if previous != current:
+                break
+            self.stable += 1
+        self.hypothesis = words
+
+        if closed:
+            cut = closed[-1][1]
+        elif not spans:
+            cut = max(0, len(self.buffer) - self.silence)
+        else:
+            cut = 0
+        self.buffer = self.buffer[cut:]
+        self.offset += cut
+
+@app.before_request
+def start_background_services():
+    model_warmup.start()
+    audio_storage.start()
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok", "uptime_seconds": round(time.monotonic() - STARTUP_STARTED, 1)})
+
+@app.route('/readyz')
+def readyz():
+    model_warmup.asr_error()
+    ready = model_warmup.ready
+    return jsonify({
+        "ready": ready,
+        "components": model_warmup.status,
+        "timings": model_warmup.timings
+    }), 200 if ready else 503
+
+class UploadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.bytes = 0
+        self.decode_seconds = 0.0
+        self.disk_bytes_written = 0
+        self.estimated_disk_bytes_saved = 0
+
+    def record(self, size, decode_seconds, persisted):
+        # Geschätzt, nicht gemessen: vorher wurde jeder Upload auf die Platte geschrieben und für ffmpeg wieder gelesen
+        saved = size if persisted else 2 * size
+        with self.lock:
+            self.uploads += 1
+            self.bytes += size
+            self.decode_seconds += decode_seconds
+            self.disk_bytes_written += size if persisted else 0
+            self.estimated_disk_bytes_saved += saved
+        return saved
+
+    def stats(self):
+        with self.lock:
+            return {
+                "uploads": self.uploads,
+                "bytes": self.bytes,
+                "avg_decode_ms": round(1000 * self.decode_seconds / self.uploads, 1) if self.uploads else None,
+                "disk_bytes_written": self.disk_bytes_written,
+                "estimated_disk_bytes_saved": self.estimated_disk_bytes_saved
+            }
+
+upload_stats = UploadStats()
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    limit_mb = app.config["MAX_UPLOAD_BYTES"] / (1024 * 1024)
+    return jsonify({"error": f"Die Datei ist zu groß (maximal {limit_mb:g} MB)."}), 413
 
 @app.route('/transcribe', methods=["POST"])
 def transcribe_route():
+    if not model_warmup.asr_ready.is_set():
+        error = model_warmup.asr_error()
+        if error:
+            return jsonify({"error": f"Die Spracherkennung konnte nicht geladen werden: {error}"}), 500
+        return jsonify({"error": "Die Spracherkennung wird noch geladen. Bitte gleich erneut versuchen."}), 503, {"Retry-After": "5"}
+
     if "audio" not in request.files:
         return jsonify({"error": "Keine Audiodatei übermittelt."}), 400
 
@@ -139,26 +2845,101 @@ def transcribe_route():
     if not filename:
         return jsonify({"error": "Ungültiger Dateiname."}), 400
 
-    temp_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    data = audio_file.stream.read(app.config["MAX_UPLOAD_BYTES"] + 1)
+    if len(data) > app.config["MAX_UPLOAD_BYTES"]:
+        return upload_too_large(None)
+    if not data:
+        return jsonify({"error": "Die Audiodatei ist leer."}), 400
 
     try:
-        audio_file.save(temp_path)
+        started = time.monotonic()
+        with stage_timer("audio_decode"):
+            audio = decode_audio_bytes(data)
+        decode_seconds = time.monotonic() - started
+
+        saved_audio = None
+        if app.config["PERSIST_UPLOADS"]:
+            extension = os.path.splitext(filename)[1].lower() or ".webm"
+            path, saved_audio = audio_storage.session_file(
+                current_session().session_id, f"answer_{uuid.uuid4().hex}{extension}"
+            )
+            with stage_timer("file_io"), open(path, "wb") as f:
+                f.write(data)
+        saved = upload_stats.record(len(data), decode_seconds, saved_audio is not None)
+        app.logger.debug(
+            f"Upload {len(data)} B in {decode_seconds * 1000:.0f} ms im Speicher dekodiert, "
+            f"geschätzt {saved} B Datei-I/O eingespart"
+        )
+
         language = request.form.get("language", "de")
-        transcription = transcribe_audio_whisper(temp_path, language)
+        try:
+            result = transcribe_answer(audio, language)
+        except TranscriptionError as e:
+            # Der Fehler erscheint wie bisher als Transkript in der Oberfläche
+            result = {"text": str(e), "segments": [], "fluency": None}
+        if result["fluency"]:
+            interaction_log.write(
+                "transcription",
+                session_id=current_session().public_id,
+                language=language,
+                segments=len(result["segments"]),
+                **result["fluency"]
+            )
         return jsonify({
-            "transcription": transcription,
-            "saved_audio": filename
+            "transcription": result["text"],
+            "segments": result["segments"],
+            "fluency": result["fluency"],
+            "saved_audio": saved_audio
         })
+    except TranscriptionQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
         app.logger.exception("Transkriptionsfehler")
         return jsonify({"error": f"Fehler bei der Transkription: {str(e)}"}), 500
 
-async def get_feedback(transcribed_response, language):
-    global current_question
+def live_transcription_socket(ws):
+    if not model_warmup.asr_ready.is_set():
+        error = model_warmup.asr_error()
+        message = f"Die Spracherkennung konnte nicht geladen werden: {error}" if error else "Die Spracherkennung wird noch geladen."
+        ws.send(json.dumps({"type": "error", "error": message}))
+        return
+    live = LiveTranscriber(request.args.get("language", "de"), current_session().public_id)
+    while True:
+        reply, done = live.handle(ws.receive())
+        if reply:
+            ws.send(json.dumps(reply, ensure_ascii=False))
+        if done:
+            break
+
+def register_live_transcription(flask_app):
+    try:
+        from flask_sock import Sock
+    except ImportError:
+        flask_app.logger.info("flask-sock ist nicht installiert, Live-Transkription über WebSocket ist deaktiviert.")
+        return None
+    sock = Sock(flask_app)
+    sock.route("/ws/transcribe")(live_transcription_socket)
+    return sock
+
+live_sock = register_live_transcription(app)
+
+FEEDBACK_VOICES = {
+    "de": "de-DE-KatjaNeural",
+    "en": "en-US-AriaNeural",
+    "fr": "fr-FR-DeniseNeural"
+}
+
+def build_feedback_turn(question, transcribed_response, language):
+    turns = {
+        "de": f"Frage: {question}\nAntwort des Schülers: {transcribed_response}",
+        "en": f"Question: {question}\nStudent's response: {transcribed_response}",
+        "fr": f"Question : {question}\nRéponse de l'étudiant : {transcribed_response}"
+    }
+    return turns.get(language, turns["en"])
+
+def build_feedback_system_prompt(language):
     prompts = {
         "de": (
-            f"Frage: {current_question}\n"
-            f"Antwort des Schülers: {transcribed_response}\n\n"
             "Bitte gib ein strukturiertes Feedback nach den GER-Kriterien für mündliche Sprachkompetenz. "
             "Formatiere die Ausgabe in Markdown ohne Meta-Kommentare. "
             "Beinhaltet die Abschnitte:\n\n"
@@ -171,8 +2952,6 @@ async def get_feedback(transcribed_response, language):
             "**Verbesserungsvorschläge:** (konkrete Tipps zur Verbesserung)\n\n"
         ),
         "en": (
-            f"Question: {current_question}\n"
-            f"Student's response: {transcribed_response}\n\n"
             "Please provide structured feedback according to the CEFR criteria for oral language proficiency. "
             "Format the output in Markdown without meta commentary. "
             "Include sections on:\n\n"
@@ -185,8 +2964,6 @@ async def get_feedback(transcribed_response, language):
             "**Improvement suggestions:** (specific tips for improvement)\n\n"
         ),
         "fr": (
-            f"Question : {current_question}\n"
-            f"Réponse de l'étudiant : {transcribed_response}\n\n"
             "Veuillez fournir un retour structuré selon les critères du CECR pour la compétence orale. "
             "Formatez la sortie en Markdown sans commentaire méta. "
             "Incluez les sections suivantes :\n\n"
@@ -200,73 +2977,269 @@ async def get_feedback(transcribed_response, language):
         )
     }
 
-    feedback_prompt = prompts.get(language, prompts["en"])
-    feedback = query_llm_via_ollama(feedback_prompt)
-    
-    save_to_file("responses_log.txt", f"Antwort auf Frage {question_count}: {transcribed_response}")
-    save_to_file("feedback_log.txt", f"Feedback für Frage {question_count}: {feedback}")
+    return prompts.get(language, prompts["en"])
 
-    plain_feedback = markdown_to_text(feedback)
+def build_feedback_prompt(question, transcribed_response, language):
+    return f"{build_feedback_turn(question, transcribed_response, language)}\n\n{build_feedback_system_prompt(language)}"
 
-    voice_map = {
-        "de": "de-DE-KatjaNeural",
-        "en": "en-US-AriaNeural",
-        "fr": "fr-FR-DeniseNeural"
-    }
-    voice = voice_map.get(language, "en-US-AriaNeural")
+def feedback_messages(state, transcribed_response, language):
+    # Der gleichbleibende Systemprompt steht vorne und ist damit über alle Sitzungen ein gemeinsamer Präfix.
+    # Ein Verlauf (QUEST_LLM_HISTORY_TURNS) ist optional, da frühere Antworten die Bewertung beeinflussen können.
+    if not app.config["LLM_CONVERSATION"]:
+        return None
+    history = state.conversation if state.conversation_language == language else []
+    return [
+        {"role": "system", "content": build_feedback_system_prompt(language)},
+        *history,
+        {"role": "user", "content": build_feedback_turn(state.current_question, transcribed_response, language)}
+    ]
+
+def remember_feedback_turn(state, language, messages, feedback):
+    if state.conversation_language != language:
+        state.conversation, state.conversation_language = [], language
+    state.conversation += [messages[-1], {"role": "assistant", "content": feedback}]
+    turns = app.config["LLM_HISTORY_TURNS"]
+    # Beim Erreichen der Grenze die ältere Hälfte auf einmal verwerfen, so bleibt der Präfix für die nächsten Runden gleich
+    if len(state.conversation) > 2 * turns:
+        state.conversation = state.conversation[-2 * (turns // 2):] if turns > 1 else []
+
+async def get_feedback(transcribed_response, language, state, use_cache=True):
+    feedback_prompt = build_feedback_prompt(state.current_question, transcribed_response, language)
+    messages = feedback_messages(state, transcribed_response, language)
+    usage = {}
+    started = time.monotonic()
+    feedback = (await run_blocking(generate_llm_cached, feedback_prompt, use_cache, messages, usage)).strip()
+    llm_seconds = time.monotonic() - started
+    if messages and app.config["LLM_HISTORY_TURNS"]:
+        remember_feedback_turn(state, language, messages, feedback)
+
+    plain_feedback = markdown_to_text(feedback)
+    voice = FEEDBACK_VOICES.get(language, "en-US-AriaNeural")
     
-    audio_file = await convert_text_to_speech(plain_feedback, f"ai_feedback_{question_count}", voice=voice)
-    return {"feedback": feedback, "audio": audio_file}
+    started = time.monotonic()
+    audio_file = await convert_text_to_speech(
+        plain_feedback, f"ai_feedback_{state.question_count}", voice=voice, session_id=state.session_id, cache=False
+    )
+    log_feedback(state, language, transcribed_response, feedback, llm_seconds, time.monotonic() - started, **usage)
+    return {"feedback": feedback, "audio": audio_file, "usage": usage}
 
-@app.route('/')
-def index():
-    return Response(HTML_CONTENT, mimetype="text/html")
+def log_feedback(state, language, transcribed_response, feedback, llm_seconds, tts_seconds, **fields):
+    common = {"session_id": state.public_id, "question_number": state.question_count, "language": language}
+    interaction_log.write("response", response=transcribed_response, **common)
+    interaction_log.write(
+        "feedback",
+        feedback=feedback,
+        llm_seconds=round(llm_seconds, 3),
+        tts_seconds=round(tts_seconds, 3),
+        **common,
+        **fields
+    )
 
-@app.route('/styles.css')
-def styles():
-    return Response(CSS_CONTENT, mimetype="text/css")
+def stream_feedback(transcribed_response, language, state, use_cache=True, slot=None):
+    feedback_prompt = build_feedback_prompt(state.current_question, transcribed_response, language)
+    messages = feedback_messages(state, transcribed_response, language)
+    usage = {}
+    count = state.question_count
+    voice = FEEDBACK_VOICES.get(language, "en-US-AriaNeural")
+    stripper = MarkdownStripper()
+    splitter = SentenceSplitter(app.config["TTS_MIN_SENTENCE_CHARS"])
+    speech = SpeechPipeline(voice, f"ai_feedback_{count}_{int(time.time())}", state.session_id)
+    playlist = []
+    parts = []
+    started = time.monotonic()
+    first_token_seconds = None
+    for token in stream_llm_via_ollama(feedback_prompt, use_cache, messages, usage, slot):
+        if first_token_seconds is None:
+            first_token_seconds = time.monotonic() - started
+        parts.append(token)
+        yield "token", {"text": token}
+        for sentence in splitter.feed(stripper.feed(token)):
+            speech.submit(sentence)
+        for index, audio_file in speech.ready():
+            playlist.append(audio_file)
+            yield "audio", {"index": index, "audio": audio_file}
+    feedback = "".join(parts).strip()
+    llm_seconds = time.monotonic() - started
+    if messages and app.config["LLM_HISTORY_TURNS"]:
+        remember_feedback_turn(state, language, messages, feedback)
+        # Die Antwort wird gestreamt, after_request hat die Sitzung daher schon vorher gespeichert. Neu laden und
+        # nur den Verlauf übernehmen, damit eine inzwischen gestellte Frage nicht überschrieben wird
+        stored = session_store.load(state.session_id)
+        if stored is not None:
+            stored.conversation, stored.conversation_language = state.conversation, state.conversation_language
+            session_store.save(state.session_id, stored)
 
-@app.route('/script.js')
-def script():
-    return Response(JS_CONTENT, mimetype="application/javascript")
+    for sentence in splitter.feed(stripper.flush()):
+        speech.submit(sentence)
+    for sentence in splitter.flush():
+        speech.submit(sentence)
+    for index, audio_file in speech.drain():
+        playlist.append(audio_file)
+        yield "audio", {"index": index, "audio": audio_file}
+    log_feedback(
+        state, language, transcribed_response, feedback, llm_seconds, time.monotonic() - started - llm_seconds,
+        first_token_seconds=round(first_token_seconds or llm_seconds, 3), streamed=True, **usage
+    )
+    yield "done", {"feedback": feedback, "playlist": playlist, "usage": usage}
 
-@app.route('/generate_question', methods=["POST"])
-def generate_question_route():
-    data = request.get_json() or {}
+async def handle_generate_question(data, state):
     topic = (data.get("topic") or "").strip()
     language = data.get("language", "de")
 
     if not topic:
-        return jsonify({"error": "Bitte gib zuerst ein Thema ein."}), 400
+        return {"error": "Bitte gib zuerst ein Thema ein."}, 400
 
     try:
-        result = asyncio.run(start_process(topic, language))
-        return jsonify(result)
+        return await start_process(topic, language, state), 200
+    except LLMOverloaded:
+        raise
+    except LLMTimeoutError as e:
+        return {"error": str(e)}, 504
     except Exception as e:
         app.logger.exception("Fehler bei der Fragenerzeugung")
-        return jsonify({"error": f"Fehler bei der Fragenerzeugung: {str(e)}"}), 500
+        return {"error": f"Fehler bei der Fragenerzeugung: {str(e)}"}, 500
+
+async def handle_feedback(data, state):
+    transcription = (data.get("transcription") or "").strip()
+    language = data.get("language", "de")
+
+    if not transcription:
+        return {"error": "Keine Antwort zum Bewerten übermittelt."}, 400
+    if not state.current_question:
+        return {"error": "Es wurde noch keine Frage gestellt."}, 400
+
+    try:
+        return await get_feedback(transcription, language, state, use_cache=not data.get("no_cache")), 200
+    except LLMOverloaded:
+        raise
+    except LLMTimeoutError as e:
+        return {"error": str(e)}, 504
+    except Exception as e:
+        app.logger.exception("Feedback-Fehler")
+        return {"error": f"Fehler beim Erzeugen des Feedbacks: {str(e)}"}, 500
+
+class StaticAsset:
+    def __init__(self, name, content, mimetype):
+        self.name = name
+        self.mimetype = mimetype
+        body = content.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        self.version = digest[:12]
+        self.digest = digest[:32]
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        try:
+            import brotli
+        except ImportError:
+            pass
+        else:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+
+    @property
+    def url(self):
+        return f"/assets/{self.version}/{self.name}"
+
+    def etag(self, encoding):
+        return self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+    def response(self, immutable=False):
+        encoding = next(
+            (name for name in ("br", "gzip") if name in self.bodies and request.accept_encodings[name]), "identity"
+        )
+        headers = {
+            "ETag": f'"{self.etag(encoding)}"',
+            "Vary": "Accept-Encoding",
+            # Fingerprint-URLs ändern sich mit dem Inhalt, alles andere wird per ETag revalidiert
+            "Cache-Control": "public, max-age=31536000, immutable" if immutable else "no-cache"
+        }
+        if any(request.if_none_match.contains_weak(self.etag(name)) for name in self.bodies):
+            return Response(status=304, headers=headers)
+        response = Response(self.bodies[encoding], mimetype=self.mimetype, headers=headers)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+@app.route('/')
+def index():
+    return static_assets["index.html"].response()
+
+@app.route('/styles.css')
+def styles():
+    return static_assets["styles.css"].response()
+
+@app.route('/script.js')
+def script():
+    return static_assets["script.js"].response()
+
+@app.route('/markdown.js')
+def markdown_script():
+    return static_assets["markdown.js"].response()
+
+@app.route('/assets/<version>/<name>')
+def fingerprinted_asset(version, name):
+    asset = static_assets.get(name)
+    if asset is None or asset.version != version or name == "index.html":
+        return jsonify({"error": "Datei nicht gefunden."}), 404
+    return asset.response(immutable=True)
+
+@app.errorhandler(LLMOverloaded)
+def llm_overloaded(error):
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), error.status, {"Retry-After": str(error.retry_after)}
+
+@app.route('/generate_question', methods=["POST"])
+def generate_question_route():
+    payload, status = async_runtime.run(handle_generate_question(request.get_json() or {}, current_session()))
+    return jsonify(payload), status
 
 @app.route('/feedback', methods=['POST'])
 def feedback():
+    payload, status = async_runtime.run(handle_feedback(request.get_json() or {}, current_session()))
+    return jsonify(payload), status
+
+@app.route('/feedback/stream', methods=['POST'])
+def feedback_stream():
     data = request.get_json() or {}
     transcription = (data.get("transcription") or "").strip()
     language = data.get("language", "de")
 
     if not transcription:
         return jsonify({"error": "Keine Antwort zum Bewerten übermittelt."}), 400
-    if not current_question:
+    state = current_session()
+    if not state.current_question:
         return jsonify({"error": "Es wurde noch keine Frage gestellt."}), 400
+    use_cache = not data.get("no_cache")
+    prompt = build_feedback_prompt(state.current_question, transcription, language)
+    slot = None
+    # Vor dem Senden der Header aufnehmen, damit eine Überlastung als 429/503 mit Retry-After beantwortet wird.
+    # Antworten aus dem Cache brauchen keinen Platz und werden auch unter Last ausgeliefert.
+    if not (use_cache and llm_cache.contains(llm_cache.key(prompt, app.config["LLM_MODEL"]))):
+        slot = llm_scheduler.reserve(LLM_PRIORITY_INTERACTIVE)
 
-    try:
-        result = asyncio.run(get_feedback(transcription, language))
-        return jsonify(result)
-    except Exception as e:
-        app.logger.exception("Feedback-Fehler")
-        return jsonify({"error": f"Fehler beim Erzeugen des Feedbacks: {str(e)}"}), 500
+    def events():
+        try:
+            for event, payload in stream_feedback(transcription, language, state, use_cache, slot):
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        except LLMOverloaded as e:
+            app.logger.warning(f"Feedback abgewiesen: {e}")
+            payload = {"error": str(e), "retry_after": e.retry_after}
+            yield f"event: error\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            app.logger.exception("Feedback-Fehler")
+            payload = {"error": f"Fehler beim Erzeugen des Feedbacks: {str(e)}"}
+            yield f"event: error\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Gibt den Platz frei, falls der Stream ihn nie übernommen hat (z.B. Abbruch vor dem ersten Token)
+    if slot:
+        response.call_on_close(slot.release)
+    return response
 
 @app.route('/clear', methods=["POST"])
 def clear():
-    cleared = clear_all()
+    cleared = clear_all(current_session())
     return jsonify({
         "question": cleared[0],
         "transcription": cleared[1],
@@ -274,9 +3247,539 @@ def clear():
         "topic": ""
     })
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "tts_cache": tts_cache.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "llm_cache": llm_cache.stats(),
+        "single_flight": {"llm": llm_flight.stats(), "tts": tts_flight.stats()},
+        "transcription": transcription_service.stats() if transcription_service else None,
+        "question_prefetch": question_prefetcher.stats() if question_prefetcher else None,
+        "audio_storage": audio_storage.stats(),
+        "uploads": upload_stats.stats()
+    })
+
+def _resident_memory(pid="self"):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def model_memory_samples():
+    samples = []
+    main = _resident_memory()
+    if main is not None:
+        samples.append(({"component": "main"}, main))
+    if transcription_service is not None:
+        workers = [_resident_memory(pid) for pid in transcription_service.worker_pids()]
+        samples.append(({"component": "asr_workers"}, sum(size for size in workers if size)))
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        samples.append(({"component": "cuda"}, torch.cuda.memory_allocated()))
+    return samples
+
+Gauge(
+    "quest_model_memory_bytes", "Speicherbedarf (RSS) von Hauptprozess und Transkriptions-Workern, CUDA-Speicher",
+    ("component",), function=model_memory_samples
+)
+Gauge("quest_llm_queue_depth", "Wartende Anfragen an das Sprachmodell", function=lambda: [({}, llm_scheduler.stats()["waiting"])])
+Gauge("quest_llm_active", "Laufende Anfragen an das Sprachmodell", function=lambda: [({}, llm_scheduler.stats()["active"])])
+Gauge(
+    "quest_transcription_queue_depth", "Wartende Transkriptionen",
+    function=lambda: [({}, transcription_service.stats()["queue_depth"])] if transcription_service else []
+)
+Gauge("quest_tts_cache_bytes", "Größe des TTS-Caches", function=lambda: [({}, tts_cache.stats()["bytes"])])
+Gauge("quest_llm_cache_hit_ratio", "Trefferquote des LLM-Caches", function=lambda: [({}, llm_cache.stats()["hit_ratio"])])
+Gauge(
+    "quest_llm_cache_saved_seconds", "Durch den LLM-Cache eingesparte Rechenzeit des Sprachmodells",
+    function=lambda: [({}, llm_cache.stats()["saved_llm_seconds"])]
+)
+
+valid_request_id = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+def resolve_request_id(header):
+    return header if header and valid_request_id.match(header) else uuid.uuid4().hex
+
+@app.before_request
+def begin_request():
+    g.request_id = resolve_request_id(request.headers.get("X-Request-ID"))
+    request_id_var.set(g.request_id)
+    g.request_started = time.perf_counter()
+    g.in_flight = True
+    HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def finish_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        HTTP_DURATION.observe(time.perf_counter() - g.request_started, route=route)
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+@app.teardown_request
+def end_request(error=None):
+    if g.pop("in_flight", False):
+        HTTP_IN_FLIGHT.dec()
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+transcode_flight = SingleFlight()
+transcode_failures = {}
+transcode_failures_lock = threading.Lock()
+TRANSCODE_RETRY_SECONDS = 3600
+
+def transcode_to_opus(source, target):
+    temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with stage_timer("transcode"):
+            subprocess.run(
+                ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source, "-vn",
+                 "-c:a", "libopus", "-b:a", app.config["AUDIO_OPUS_BITRATE"], "-application", "voip",
+                 "-f", "webm", temp_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+                timeout=120
+            )
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return target
+
+def transcode_variant(filename, source, target):
+    # Fehlschläge (z.B. fehlendes ffmpeg) merken, statt bei jeder Anfrage erneut zu transkodieren
+    now = time.monotonic()
+    with transcode_failures_lock:
+        failed_at = transcode_failures.get(target)
+        if failed_at is not None and now - failed_at < TRANSCODE_RETRY_SECONDS:
+            return False
+    try:
+        transcode_flight.do(target, transcode_to_opus, source, target)
+    except (OSError, subprocess.SubprocessError) as e:
+        app.logger.warning(f"Opus-Transkodierung von {filename} fehlgeschlagen, liefere MP3: {e}")
+        with transcode_failures_lock:
+            for stale in [path for path, failed_at in transcode_failures.items() if now - failed_at >= TRANSCODE_RETRY_SECONDS]:
+                del transcode_failures[stale]
+            transcode_failures[target] = now
+        return False
+    if filename.startswith(f"{tts_cache.subdir}/"):
+        tts_cache.add_variant(os.path.basename(source)[:-4])
+    return True
+
+def wants_opus():
+    requested = request.args.get("format")
+    if requested:
+        return requested == "opus"
+    return request.accept_mimetypes.best_match(["audio/mpeg", "audio/webm"]) == "audio/webm"
+
 @app.route('/audio/<path:filename>')
 def serve_audio(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    path = safe_join(app.config["UPLOAD_FOLDER"], filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Audiodatei nicht gefunden."}), 404
+
+    mimetype = None
+    if app.config["AUDIO_OPUS"] and filename.endswith(".mp3") and wants_opus():
+        target = path[:-4] + ".webm"
+        if os.path.exists(target) or transcode_variant(filename, path, target):
+            path, mimetype = target, "audio/webm"
+
+    # send_file beantwortet Range-Anfragen (206) und If-None-Match/If-Modified-Since selbst
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True)
+    if filename.startswith(f"{tts_cache.subdir}/"):
+        # Dateinamen im TTS-Cache sind Inhalts-Hashes und ändern sich nie
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, max-age=3600"
+    if app.config["AUDIO_OPUS"] and filename.endswith(".mp3"):
+        response.vary.add("Accept")
+    return response
+
+class QuestASGIApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.routes = {
+            ("POST", "/generate_question"): handle_generate_question,
+            ("POST", "/feedback"): handle_feedback
+        }
+        self._wsgi = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http" and (scope["method"], scope["path"]) in self.routes:
+            await self._handle(self.routes[(scope["method"], scope["path"])], scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self._websocket(scope, receive, send)
+        else:
+            if self._wsgi is None:
+                from asgiref.wsgi import WsgiToAsgi
+                self._wsgi = WsgiToAsgi(self.flask_app)
+            await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                model_warmup.start()
+                audio_storage.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _session_cookie(self, scope):
+        cookies = SimpleCookie()
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                cookies.load(value.decode("latin-1"))
+        return cookies[SESSION_COOKIE].value if SESSION_COOKIE in cookies else None
+
+    async def _websocket(self, scope, receive, send):
+        await receive()
+        if scope["path"] != "/ws/transcribe" or not model_warmup.asr_ready.is_set():
+            # 1011: Laden der Spracherkennung fehlgeschlagen, 1013: später erneut versuchen
+            failed = scope["path"] == "/ws/transcribe" and model_warmup.asr_error()
+            await send({"type": "websocket.close", "code": 1011 if failed else 1013})
+            return
+        language = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("language", ["de"])[0]
+        live = LiveTranscriber(language, public_session_id(self._session_cookie(scope)))
+        await send({"type": "websocket.accept"})
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            payload = message.get("bytes")
+            reply, done = await run_blocking(live.handle, payload if payload is not None else message.get("text", ""))
+            if reply:
+                await send({"type": "websocket.send", "text": json.dumps(reply, ensure_ascii=False)})
+            if done:
+                await send({"type": "websocket.close", "code": 1000})
+                return
+
+    async def _handle(self, handler, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            data = {}
+
+        request_headers = dict(scope["headers"])
+        request_id = resolve_request_id(request_headers.get(b"x-request-id", b"").decode("latin-1"))
+        request_id_var.set(request_id)
+        headers = [(b"x-request-id", request_id.encode("ascii"))]
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            sid, state = load_session(self._session_cookie(scope))
+            try:
+                payload, status = await handler(data if isinstance(data, dict) else {}, state)
+            except LLMOverloaded as e:
+                payload, status = {"error": str(e), "retry_after": e.retry_after}, e.status
+                headers.append((b"retry-after", str(e.retry_after).encode("ascii")))
+            await run_blocking(session_store.save, sid, state)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+        HTTP_REQUESTS.inc(route=scope["path"], method=scope["method"], status=status)
+        HTTP_DURATION.observe(time.perf_counter() - started, route=scope["path"])
+
+        response = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        cookie = f"{SESSION_COOKIE}={sid}; Max-Age={app.config['SESSION_TTL']}; Path=/; HttpOnly; SameSite=Lax"
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(response)).encode("ascii")),
+                (b"set-cookie", cookie.encode("latin-1"))
+            ] + headers
+        })
+        await send({"type": "http.response.body", "body": response})
+
+asgi_app = QuestASGIApp(app)
+
+def run_load_test(base_urls, concurrency, rounds, topic, language, answer):
+    import urllib.request, http.cookiejar
+
+    def learner(base_url, timings):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        for _ in range(rounds):
+            for path, payload in (
+                ("/generate_question", {"topic": topic, "language": language}),
+                ("/feedback", {"transcription": answer, "language": language})
+            ):
+                request_ = urllib.request.Request(
+                    base_url.rstrip("/") + path,
+                    data=json.dumps(payload).encode("utf-8"),
+                    headers={"Content-Type": "application/json"}
+                )
+                started = time.perf_counter()
+                try:
+                    with opener.open(request_, timeout=600) as response:
+                        response.read()
+                    ok = True
+                except Exception:
+                    ok = False
+                timings.append((path, time.perf_counter() - started, ok))
+
+    print(f"{'Server':<32}{'Anfragen':>10}{'Fehler':>8}{'Dauer [s]':>11}{'Anfr./s':>9}{'p50 [s]':>9}{'p95 [s]':>9}")
+    results = []
+    for base_url in base_urls:
+        timings = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: learner(base_url, timings), range(concurrency)))
+        duration = time.perf_counter() - started
+        latencies = sorted(elapsed for _, elapsed, _ in timings)
+        errors = sum(1 for _, _, ok in timings if not ok)
+        row = {
+            "url": base_url,
+            "requests": len(timings),
+            "errors": errors,
+            "seconds": duration,
+            "throughput": len(timings) / duration if duration else 0.0,
+            "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        }
+        results.append(row)
+        print(
+            f"{base_url:<32}{row['requests']:>10}{errors:>8}{duration:>11.1f}"
+            f"{row['throughput']:>9.2f}{row['p50']:>9.2f}{row['p95']:>9.2f}"
+        )
+    return results
+
+GRADE_FIELDS = [
+    "id", "question", "audio", "language", "transcription", "cefr_level", "feedback", "feedback_audio", "fluency",
+    "audio_seconds", "asr_seconds", "llm_seconds", "tts_seconds", "prompt_eval_count", "eval_count", "error"
+]
+
+def read_grading_manifest(path, default_language):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".json")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    jobs = []
+    seen = set()
+    for number, row in enumerate(rows, 1):
+        audio = str(row.get("audio") or "").strip()
+        job = {
+            "id": str(row.get("id") or audio or number).strip(),
+            "question": str(row.get("question") or "").strip(),
+            "audio": audio,
+            "language": str(row.get("language") or default_language).strip(),
+            "path": os.path.join(base, audio) if audio else ""
+        }
+        if job["id"] in seen:
+            raise SystemExit(f"Doppelte id '{job['id']}' in {path} (Zeile {number}).")
+        seen.add(job["id"])
+        jobs.append(job)
+    return jobs
+
+def graded_records_end(data, jsonl):
+    # Ende des letzten vollständigen Datensatzes, danach steht höchstens der Rest eines abgebrochenen Laufs
+    if jsonl:
+        return data.rfind(b"\n") + 1
+    # Zeilenumbrüche innerhalb von Anführungszeichen gehören zum Feld und beenden keinen CSV-Datensatz
+    end = offset = 0
+    for index, part in enumerate(data.split(b'"')):
+        if index % 2 == 0 and b"\n" in part:
+            end = offset + part.rfind(b"\n") + 1
+        offset += len(part) + 1
+    return end
+
+def read_graded_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    jsonl = path.lower().endswith(".jsonl")
+    with open(path, "rb") as f:
+        data = f.read()
+    text = data[:graded_records_end(data, jsonl)].decode("utf-8")
+    if jsonl:
+        rows = []
+        for line in text.splitlines():
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+    else:
+        rows = csv.DictReader(io.StringIO(text, newline=""))
+    # Fertig ist eine Zeile nur mit leerer error-Spalte, fehlgeschlagene Antworten werden erneut bewertet
+    for row in rows:
+        if row.get("error") == "":
+            done.add(row["id"])
+    return done
+
+class GradingOutput:
+    def __init__(self, path):
+        self.jsonl = path.lower().endswith(".jsonl")
+        end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                end = graded_records_end(f.read(), self.jsonl)
+            # Den abgeschnittenen letzten Datensatz eines abgebrochenen Laufs verwerfen
+            os.truncate(path, end)
+        fresh = end == 0
+        self.file = open(path, "a", encoding="utf-8", newline="")
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.file, GRADE_FIELDS, extrasaction="ignore")
+            if fresh:
+                self.writer.writeheader()
+
+    def write(self, result):
+        row = {field: result.get(field) for field in GRADE_FIELDS}
+        row["error"] = row["error"] or ""
+        if self.jsonl:
+            self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            self.writer.writerow({
+                field: json.dumps(value, ensure_ascii=False) if isinstance(value, dict) else value
+                for field, value in row.items()
+            })
+        # Jede Zeile sofort schreiben, damit ein abgebrochener Lauf fortgesetzt werden kann
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def extract_cefr_level(feedback):
+    match = re.search(
+        r'(?:Gesamtniveau|Overall CEFR level|Niveau global)[\s\S]{0,60}?\b([ABC][12])\b', feedback, re.IGNORECASE
+    )
+    return match.group(1) if match else ""
+
+class BatchGrader:
+    # Jede Antwort wandert in die nächste Stufe, sobald die vorige fertig ist: ASR, Feedback, optional Sprachausgabe
+    def __init__(self, asr_threads, llm_concurrency, audio_dir=None):
+        self.audio_dir = audio_dir
+        self.results = queue.Queue()
+        self.stages = {
+            "asr": ThreadPoolExecutor(max_workers=asr_threads, thread_name_prefix="grade-asr"),
+            "llm": ThreadPoolExecutor(max_workers=llm_concurrency, thread_name_prefix="grade-llm"),
+            "tts": ThreadPoolExecutor(max_workers=app.config["TTS_CONCURRENCY"], thread_name_prefix="grade-tts")
+        }
+
+    def submit(self, job):
+        self.stages["asr"].submit(self._run, "asr", self._transcribe, job)
+
+    def _run(self, stage, func, job):
+        started = time.monotonic()
+        try:
+            following = func(job)
+        except Exception as e:
+            job["error"] = f"{stage}: {e}"
+            following = None
+        job[f"{stage}_seconds"] = round(time.monotonic() - started, 3)
+        if following:
+            self.stages[following[0]].submit(self._run, *following, job)
+        else:
+            self.results.put(job)
+
+    def _transcribe(self, job):
+        if not job["question"] or not job["audio"]:
+            raise ValueError("Frage oder Audiodatei fehlt in der Manifestzeile.")
+        with stage_timer("file_io"), open(job["path"], "rb") as f:
+            data = f.read()
+        with stage_timer("audio_decode"):
+            audio = decode_audio_bytes(data)
+        result = transcribe_answer(audio, job["language"])
+        job.update(transcription=result["text"], fluency=result["fluency"], audio_seconds=round(len(audio) / 16000, 2))
+        # Ohne erkannte Sprache gibt es nichts zu bewerten, die Zeile bleibt zur Durchsicht ohne Feedback
+        if result["empty"]:
+            return None
+        return "llm", self._grade
+
+    def _grade(self, job):
+        usage = {}
+        prompt = build_feedback_prompt(job["question"], job["transcription"], job["language"])
+        feedback = generate_llm_cached(prompt, True, None, usage).strip()
+        job.update(
+            feedback=feedback,
+            cefr_level=extract_cefr_level(feedback),
+            prompt_eval_count=usage.get("prompt_eval_count"),
+            eval_count=usage.get("eval_count")
+        )
+        return ("tts", self._speak) if self.audio_dir else None
+
+    def _speak(self, job):
+        digest = hashlib.sha256(job["id"].encode("utf-8")).hexdigest()[:8]
+        path = os.path.join(self.audio_dir, f"{secure_filename(job['id'])[:60]}_{digest}.mp3")
+        voice = FEEDBACK_VOICES.get(job["language"], "en-US-AriaNeural")
+        async_runtime.run(self._synthesize(markdown_to_text(job["feedback"]), voice, path))
+        job["feedback_audio"] = path
+
+    @staticmethod
+    async def _synthesize(text, voice, path):
+        import edge_tts
+        with stage_timer("tts"):
+            await edge_tts.Communicate(text, voice=voice).save(path)
+
+    def shutdown(self):
+        for executor in self.stages.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def run_batch_grading(manifest, output, language, asr_workers, llm_concurrency, audio_dir=None):
+    jobs = read_grading_manifest(manifest, language)
+    done = read_graded_ids(output)
+    pending = [job for job in jobs if job["id"] not in done]
+    print(f"{len(jobs)} Antworten im Manifest, {len(jobs) - len(pending)} bereits bewertet, {len(pending)} offen")
+    if not pending:
+        return []
+
+    app.config["WHISPER_WORKERS"] = asr_workers
+    # Die ASR-Threads begrenzen die Last selbst, im Stapelbetrieb soll die Warteschlange nicht abweisen
+    app.config["WHISPER_QUEUE_SIZE"] = 0
+    llm_scheduler.concurrency = llm_concurrency
+    if audio_dir:
+        os.makedirs(audio_dir, exist_ok=True)
+    grader = BatchGrader(max(1, asr_workers) * app.config["WHISPER_BATCH_SIZE"], llm_concurrency, audio_dir)
+    writer = GradingOutput(output)
+    results = []
+    started = time.monotonic()
+    try:
+        for job in pending:
+            grader.submit(job)
+        while len(results) < len(pending):
+            result = grader.results.get()
+            writer.write(result)
+            results.append(result)
+            status = result.get("error") or result.get("cefr_level") or "ohne Feedback"
+            print(f"[{len(results)}/{len(pending)}] {result['id']}: {status}")
+    except KeyboardInterrupt:
+        print("Abgebrochen, ein erneuter Aufruf setzt mit den offenen Antworten fort.")
+        raise SystemExit(130)
+    finally:
+        grader.shutdown()
+        writer.close()
+        if transcription_service is not None:
+            transcription_service.shutdown()
+
+    elapsed = time.monotonic() - started
+    failed = sum(1 for result in results if result.get("error"))
+    audio_seconds = sum(result.get("audio_seconds") or 0 for result in results)
+    print(
+        f"{len(results) - failed} bewertet, {failed} fehlgeschlagen in {elapsed:.1f} s "
+        f"({audio_seconds / 60:.1f} min Audio): {3600 * len(results) / elapsed:.0f} Antworten/h"
+    )
+    for stage in ("asr", "llm", "tts"):
+        timings = [result[f"{stage}_seconds"] for result in results if f"{stage}_seconds" in result]
+        if timings:
+            print(f"  {stage}: {sum(timings) / len(timings):.2f} s pro Antwort im Mittel, {len(timings)} Antworten")
+    return results
 
 HTML_CONTENT = """
 <html lang="de">
@@ -342,7 +3845,7 @@ HTML_CONTENT = """
       <button id="clear-btn">Zurücksetzen</button>
     </div>
   </div>
-  <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
+  <script src="/markdown.js"></script>
   <script src="/script.js"></script>
 </body>
 </html>
@@ -790,7 +4293,7 @@ function showTopicError(message) {
         autoResize(questionOutput);
 
         if (data.audio) {
-          questionAudio.src = "/audio/" + data.audio;
+          questionAudio.src = generatedAudioUrl(data.audio);
           questionAudio.style.display = 'block';
           questionAudio.play();
         }
@@ -851,6 +4354,83 @@ function showTopicError(message) {
 
   let mediaRecorder;
   let recordedChunks = [];
+  let liveTranscription = null;
+
+  function startLiveTranscription(stream) {
+    const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+    if (!window.WebSocket || !AudioContextClass) return null;
+    let socket = null;
+    let context = null;
+    try {
+      const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+      socket = new WebSocket(`${protocol}//${location.host}/ws/transcribe?language=${selectedLanguage}`);
+      socket.binaryType = 'arraybuffer';
+      // Firefox verbindet keine Mikrofonspur mit abweichender Abtastrate, daher Standardrate und eigene Umrechnung auf 16 kHz
+      context = new AudioContextClass();
+      const source = context.createMediaStreamSource(stream);
+      const processor = context.createScriptProcessor(4096, 1, 1);
+      const live = { socket, context, pending: [] };
+      live.done = new Promise(resolve => { live.resolve = resolve; });
+      const ratio = context.sampleRate / 16000;
+      let offset = 0;
+
+      processor.onaudioprocess = (event) => {
+        const input = event.inputBuffer.getChannelData(0);
+        const samples = [];
+        for (; offset < input.length; offset += ratio) {
+          const start = Math.floor(offset);
+          const end = Math.min(input.length, Math.max(start + 1, Math.floor(offset + ratio)));
+          let sum = 0;
+          for (let i = start; i < end; i++) sum += input[i];
+          samples.push(sum / (end - start));
+        }
+        offset -= input.length;
+        const pcm = Int16Array.from(samples, value => Math.max(-1, Math.min(1, value)) * 0x7fff);
+        if (socket.readyState === WebSocket.OPEN) {
+          socket.send(pcm.buffer);
+        } else if (socket.readyState === WebSocket.CONNECTING) {
+          live.pending.push(pcm.buffer);
+        }
+      };
+      source.connect(processor);
+      processor.connect(context.destination);
+
+      socket.onopen = () => {
+        live.pending.forEach(chunk => socket.send(chunk));
+        live.pending = [];
+      };
+      socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'partial') {
+          transcribedOutput.value = [message.committed, message.stable, message.tentative].filter(Boolean).join(' ');
+        } else if (message.type === 'final') {
+          live.resolve(message);
+        } else if (message.type === 'error') {
+          console.error(message.error);
+          live.resolve(null);
+        }
+      };
+      socket.onerror = () => live.resolve(null);
+      socket.onclose = () => live.resolve(null);
+      return live;
+    } catch (error) {
+      // Ohne Live-Transkription wird die Aufnahme wie bisher über /transcribe hochgeladen
+      console.error('Live-Transkription nicht verfügbar:', error);
+      if (context) context.close();
+      if (socket) socket.close();
+      return null;
+    }
+  }
+
+  function stopLiveTranscription(live) {
+    live.context.close();
+    if (live.socket.readyState === WebSocket.OPEN) {
+      live.socket.send(JSON.stringify({ type: 'stop' }));
+    } else {
+      live.resolve(null);
+    }
+    return live.done;
+  }
   
   startRecordingBtn.addEventListener('click', async () => {
     if (useWebSpeech) {
@@ -864,21 +4444,34 @@ function showTopicError(message) {
         const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
         mediaRecorder = new MediaRecorder(stream);
         recordedChunks = [];
+        liveTranscription = startLiveTranscription(stream);
         mediaRecorder.ondataavailable = function(event) {
           if (event.data.size > 0) {
             recordedChunks.push(event.data);
           }
         };
-        mediaRecorder.onstop = function() {
+        mediaRecorder.onstop = async function() {
           const blob = new Blob(recordedChunks, { type: 'audio/webm' });
+          audioSpinner.style.display = 'block';
+          const live = liveTranscription;
+          liveTranscription = null;
+          const final = live ? await stopLiveTranscription(live) : null;
+          if (final) {
+            transcribedOutput.value = final.transcription;
+            recordedAudio.src = URL.createObjectURL(blob);
+            recordedAudio.style.display = 'block';
+            recordedAudio.play();
+            audioSpinner.style.display = 'none';
+            return;
+          }
           const formData = new FormData();
           formData.append('audio', blob, 'recorded_audio.webm');
-          audioSpinner.style.display = 'block';
+          formData.append('language', selectedLanguage);
           fetch('/transcribe', { method: 'POST', body: formData })
             .then(response => response.json())
             .then(data => {
               transcribedOutput.value = data.transcription;
-              recordedAudio.src = "/audio/" + data.saved_audio;
+              recordedAudio.src = data.saved_audio ? "/audio/" + data.saved_audio : URL.createObjectURL(blob);
               recordedAudio.style.display = 'block';
               recordedAudio.play();
             })
@@ -960,6 +4553,31 @@ function showTopicError(message) {
       });
   });
 
+  let feedbackPlaylist = [];
+  const opusSupported = !!document.createElement('audio').canPlayType('audio/webm; codecs="opus"');
+
+  function generatedAudioUrl(file) {
+    return "/audio/" + file + (opusSupported ? "?format=opus" : "");
+  }
+
+  function enqueueFeedbackAudio(file) {
+    if (!file) return;
+    feedbackPlaylist.push(generatedAudioUrl(file));
+    feedbackAudio.style.display = "block";
+    if (!feedbackAudio.getAttribute("src") || feedbackAudio.ended) {
+      playNextFeedbackAudio();
+    }
+  }
+
+  function playNextFeedbackAudio() {
+    const next = feedbackPlaylist.shift();
+    if (!next) return;
+    feedbackAudio.src = next;
+    feedbackAudio.play();
+  }
+
+  feedbackAudio.addEventListener("ended", playNextFeedbackAudio);
+
   feedbackBtn.addEventListener("click", function () {
     const transcription = (transcribedOutput.value || "").trim();
 
@@ -977,25 +4595,67 @@ function showTopicError(message) {
     }
 
     document.getElementById("feedback-spinner").style.display = "block";
+    feedbackOutput.innerHTML = "";
+    feedbackAudio.style.display = "none";
+    feedbackPlaylist = [];
+    feedbackAudio.removeAttribute("src");
+
+    let feedbackText = "";
+    let renderPending = false;
+    const render = () => {
+      if (renderPending) return;
+      renderPending = true;
+      requestAnimationFrame(() => {
+        renderPending = false;
+        feedbackOutput.innerHTML = marked.parse(feedbackText);
+      });
+    };
+
+    const handleEvent = (event, data) => {
+      if (event === "token") {
+        document.getElementById("feedback-spinner").style.display = "none";
+        feedbackText += data.text || "";
+        render();
+      } else if (event === "audio") {
+        enqueueFeedbackAudio(data.audio);
+      } else if (event === "done") {
+        feedbackText = data.feedback || feedbackText;
+        render();
+      } else if (event === "error") {
+        throw data;
+      }
+    };
 
-    fetch("/feedback", {
+    fetch("/feedback/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({ transcription: transcription, language: selectedLanguage }),
     })
-      .then(r => r.ok ? r.json() : r.json().then(e => { throw e; }))
-      .then(data => {
-        if (data.error) throw data;
+      .then(async r => {
+        if (!r.ok) throw await r.json();
 
-        showBox('feedback-error', '', ''); 
         const box = document.getElementById('feedback-error');
         if (box) box.style.display = 'none';
 
-        feedbackOutput.innerHTML = marked.parse(data.feedback || '');
-        if (data.audio) {
-          feedbackAudio.src = "/audio/" + data.audio;
-          feedbackAudio.style.display = "block";
-          feedbackAudio.play();
+        const reader = r.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          let boundary;
+          while ((boundary = buffer.indexOf("\\n\\n")) !== -1) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = "message";
+            let payload = "";
+            block.split("\\n").forEach(line => {
+              if (line.startsWith("event:")) event = line.slice(6).trim();
+              else if (line.startsWith("data:")) payload += line.slice(5).trim();
+            });
+            handleEvent(event, payload ? JSON.parse(payload) : {});
+          }
         }
       })
       .catch(err => {
@@ -1024,6 +4684,7 @@ function showTopicError(message) {
         feedbackOutput.innerHTML = data.feedback || "";
         questionAudio.style.display = 'none';
         feedbackAudio.style.display = 'none';
+        feedbackPlaylist = [];
         recordedAudio.src = "";
         recordedAudio.style.display = "none";
         document.getElementById('topic-input').value = data.topic;
@@ -1051,5 +4712,172 @@ function showTopicError(message) {
 });
 """
 
+MARKDOWN_JS_CONTENT = r"""
+(function () {
+  // Kleiner Markdown-Renderer für das Feedback (Überschriften, Listen, Hervorhebungen, Code, Links)
+  function escapeHtml(text) {
+    return text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+  }
+
+  function inline(text) {
+    const codes = [];
+    text = escapeHtml(text).replace(/`([^`]+)`/g, (match, code) => {
+      codes.push(code);
+      return "\u0000" + (codes.length - 1) + "\u0000";
+    });
+    text = text
+      .replace(/\*\*(.+?)\*\*|__(.+?)__/g, (match, a, b) => "<strong>" + (a || b) + "</strong>")
+      .replace(/\*([^*\s][^*]*?)\*/g, "<em>$1</em>")
+      .replace(/(^|\W)_([^_]+)_(?=\W|$)/g, "$1<em>$2</em>")
+      .replace(/\[([^\]]+)\]\((https?:\/\/[^\s)]+)\)/g, '<a href="$2" target="_blank" rel="noopener">$1</a>');
+    return text.replace(/\u0000(\d+)\u0000/g, (match, index) => "<code>" + codes[index] + "</code>");
+  }
+
+  function parse(markdown) {
+    const lines = String(markdown || "").replace(/\r\n?/g, "\n").split("\n");
+    const html = [];
+    let paragraph = [];
+    let list = null;
+    let code = null;
+
+    const flushParagraph = () => {
+      if (paragraph.length) {
+        html.push("<p>" + paragraph.map(inline).join("<br>") + "</p>");
+        paragraph = [];
+      }
+    };
+    const closeList = () => {
+      if (list) {
+        html.push("</" + list + ">");
+        list = null;
+      }
+    };
+
+    for (const line of lines) {
+      if (code !== null) {
+        if (/^\s*```/.test(line)) {
+          html.push("<pre><code>" + escapeHtml(code.join("\n")) + "</code></pre>");
+          code = null;
+        } else {
+          code.push(line);
+        }
+        continue;
+      }
+      const heading = /^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$/.exec(line);
+      const item = /^\s*(?:([-*+])|\d+[.)])\s+(.*)$/.exec(line);
+      const quote = /^\s*>\s?(.*)$/.exec(line);
+      if (/^\s*```/.test(line)) {
+        flushParagraph();
+        closeList();
+        code = [];
+      } else if (/^\s*$/.test(line)) {
+        flushParagraph();
+        closeList();
+      } else if (/^\s*([-*_])(\s*\1){2,}\s*$/.test(line)) {
+        flushParagraph();
+        closeList();
+        html.push("<hr>");
+      } else if (heading) {
+        flushParagraph();
+        closeList();
+        const level = heading[1].length;
+        html.push(`<h${level}>${inline(heading[2])}</h${level}>`);
+      } else if (item) {
+        flushParagraph();
+        const type = item[1] ? "ul" : "ol";
+        if (list !== type) {
+          closeList();
+          html.push("<" + type + ">");
+          list = type;
+        }
+        html.push("<li>" + inline(item[2]) + "</li>");
+      } else if (quote) {
+        flushParagraph();
+        closeList();
+        html.push("<blockquote><p>" + inline(quote[1]) + "</p></blockquote>");
+      } else if (list && /^\s+\S/.test(line)) {
+        html[html.length - 1] = html[html.length - 1].replace(/<\/li>$/, " " + inline(line.trim()) + "</li>");
+      } else {
+        closeList();
+        paragraph.push(line.trim());
+      }
+    }
+    if (code !== null) {
+      html.push("<pre><code>" + escapeHtml(code.join("\n")) + "</code></pre>");
+    }
+    flushParagraph();
+    closeList();
+    return html.join("\n");
+  }
+
+  window.marked = { parse: parse };
+})();
+"""
+
+def build_static_assets():
+    assets = {
+        "styles.css": StaticAsset("styles.css", CSS_CONTENT, "text/css"),
+        "markdown.js": StaticAsset("markdown.js", MARKDOWN_JS_CONTENT, "application/javascript"),
+        "script.js": StaticAsset("script.js", JS_CONTENT, "application/javascript")
+    }
+    html = HTML_CONTENT
+    for name, asset in assets.items():
+        html = html.replace(f'"/{name}"', f'"{asset.url}"')
+    assets["index.html"] = StaticAsset("index.html", html, "text/html")
+    return assets
+
+static_assets = build_static_assets()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QUEST V1")
+    commands = parser.add_subparsers(dest="command")
+    parser.set_defaults(asgi=False, host="127.0.0.1", port=5000)
+    serve = commands.add_parser("serve", help="Webanwendung starten (Standard)")
+    serve.add_argument("--asgi", action="store_true", help="Über uvicorn mit einer gemeinsamen Ereignisschleife ausliefern")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=5000)
+    benchmark = commands.add_parser("benchmark-asr", help="ASR-Backends auf einem lokalen Audio-Satz vergleichen")
+    benchmark.add_argument("audio_dir", help="Ordner mit Audiodateien und gleichnamigen .txt-Referenztranskripten")
+    benchmark.add_argument("--engines", default=",".join(ASR_BACKENDS), help="Kommagetrennte Liste der Backends")
+    benchmark.add_argument("--sizes", default=app.config["WHISPER_MODEL"], help="Kommagetrennte Liste der Modellgrößen")
+    benchmark.add_argument("--language", default="de")
+    loadtest = commands.add_parser("loadtest", help="Parallele Lernende gegen einen oder mehrere Server simulieren")
+    loadtest.add_argument("urls", nargs="+", help="Basis-URLs, z.B. http://127.0.0.1:5000 http://127.0.0.1:8000")
+    loadtest.add_argument("--concurrency", type=int, default=20)
+    loadtest.add_argument("--rounds", type=int, default=3, help="Frage-Feedback-Durchläufe pro Lernendem")
+    loadtest.add_argument("--topic", default="Reisen")
+    loadtest.add_argument("--language", default="de")
+    loadtest.add_argument("--answer", default="Ich würde gerne im Sommer nach Italien fahren, weil es dort warm ist.")
+    grade = commands.add_parser("grade", help="Aufgezeichnete Antworten aus einer Manifestdatei gesammelt bewerten")
+    grade.add_argument("manifest", help="CSV- oder JSONL-Datei mit den Spalten question, audio, language und optional id")
+    grade.add_argument("-o", "--output", required=True, help="Ergebnisdatei (.csv oder .jsonl), vorhandene Ergebnisse werden übersprungen")
+    grade.add_argument("--language", default="de", help="Sprache für Zeilen ohne language-Spalte")
+    grade.add_argument("--asr-workers", type=int, default=app.config["WHISPER_WORKERS"], help="Prozesse für die Spracherkennung")
+    grade.add_argument("--llm-concurrency", type=int, default=app.config["LLM_CONCURRENCY"], help="Gleichzeitige Feedback-Anfragen an das Modell")
+    grade.add_argument("--audio-dir", help="Ordner für das vorgelesene Feedback (Standard: <Ergebnisdatei>_audio)")
+    grade.add_argument("--no-tts", action="store_true", help="Kein Audio-Feedback erzeugen")
+    bench_markdown = commands.add_parser("bench-markdown", help="Markdown-Entfernung mit markdown+BeautifulSoup vergleichen")
+    bench_markdown.add_argument("--iterations", type=int, default=2000)
+    bench_markdown.add_argument("--chunk-size", type=int, default=3, help="Zeichen pro simuliertem LLM-Token")
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark-asr":
+        run_asr_benchmark(args.audio_dir, args.engines.split(","), args.sizes.split(","), args.language)
+    elif args.command == "loadtest":
+        run_load_test(args.urls, args.concurrency, args.rounds, args.topic, args.language, args.answer)
+    elif args.command == "grade":
+        audio_dir = None if args.no_tts else args.audio_dir or os.path.splitext(args.output)[0] + "_audio"
+        run_batch_grading(args.manifest, args.output, args.language, args.asr_workers, args.llm_concurrency, audio_dir)
+    elif args.command == "bench-markdown":
+        run_markdown_benchmark(args.iterations, args.chunk_size)
+    elif args.asgi:
+        import uvicorn
+        uvicorn.run(asgi_app, host=args.host, port=args.port)
+    else:
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            model_warmup.start()
+            audio_storage.start()
+        app.run(host=args.host, port=args.port, debug=True)
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    main()